@@ -4,21 +4,133 @@
 # Bryan Sutula, Red Hat, revised 4/20/23
 # Released under GPL version 2
 
+import argparse                         # Command line parsing
+import atexit                           # Scratch space clean-up
+import datetime                         # Timing the analysis stages
+import io                               # In-memory files for DB COPY
 import json
 import os                               # Environment variable support
 import fcntl                            # Lower-level file control
+import hashlib                          # Used to compute SWH UUIDs
+import heapq                            # Balancing scancode shards
+import multiprocessing                  # Parallel file hashing
+import threading                        # Collecting scancode shard output
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor, \
+                               wait, FIRST_COMPLETED
+from queue import Queue
 import subprocess                       # To execute command line *stuff*
 import re                               # Regular expression support
-import time                             # May not be needed
+import resource                         # Resources used by child processes
+import select                           # Waiting for DB notifications
+import shutil                           # Tree copies for the extraction cache
+import socket                           # Host name, scancode service
+import time                             # Scheduling the analysis queue
+import urllib.parse                     # Naming downloaded archives
+import zipfile                          # Unpacking zip archives
+import tarfile                          # ...tar archives
+import gzip, bz2, lzma                  # ...and compressed files
 import requests                         # In order to upload analysis jsons
+import urllib3                          # Errors reading downloads
 import psycopg2                         # Postgress connector library
 from pyrpm.spec import Spec, replace_macros # For parsing rpm spec files
 
 
 # Global constants
 tmpdir = "/tmp/oslcrs/"                 # Directory used to store working files
+SCRATCH = os.environ.get("OSLCRS_SCRATCH", tmpdir).rstrip('/')
+                                        # Volume where sources are fetched,
+                                        # unpacked and scanned
+SCRATCH_RATIO = int(os.environ.get("OSLCRS_SCRATCH_RATIO", "8"))
+                                        # Unpacked size assumed for archives,
+                                        # as a multiple of the archive size,
+                                        # when their metadata doesn't say
+SCRATCH_FREE = int(os.environ.get("OSLCRS_SCRATCH_FREE_GB", "5")) * 1024 ** 3
+                                        # Space always left free there
+SCRATCH_WAIT = 30                       # Seconds between checks for space
+                                        # (scratch or memory)
+MEMORY_DEFAULT = 2 * 1024 ** 3          # Peak memory assumed for a scancode
+                                        # process, before there's a history
+MEMORY_MARGIN = 1.25                    # Headroom over the predicted peak
+MEMORY_HISTORY = 200                    # Recent scans the resource model is
+                                        # fitted to
+partdir = SCRATCH + "/partial"          # Unfinished downloads, shared by all
+                                        # the workers
 RETRIES = 3                             # Number of analysis retries before
                                         # we consider this a failed run
+FILE_BATCH = 5000                       # Number of file UUIDs looked up in
+                                        # the DB with a single query
+HASH_CHUNK = 1024 * 1024                # Bytes read at a time when computing
+                                        # a file UUID; caps memory per file
+HASH_WORKERS = len(os.sched_getaffinity(0)) # Processes used to hash files
+HASH_POOL_MIN = 256                     # Below this many files, don't bother
+                                        # starting the hashing processes
+EXTRACT_MEMBERS = int(os.environ.get("OSLCRS_EXTRACT_MEMBERS", "5000000"))
+                                        # Most members unpacked from an archive
+EXTRACT_BYTES = 20 * 1024 ** 3          # Most bytes unpacked from an archive
+EXTRACT_RATIO = 200                     # Most an archive may expand by...
+EXTRACT_RATIO_MIN = 100 * 1024 ** 2     # ...once this many bytes are unpacked
+EXTRACT_DEPTH = 16                      # Levels of nested archives unpacked
+TINY_FILE = 2                           # Files shorter than this are skipped
+INGEST_BATCH = 1000                     # Number of scanned files recorded
+                                        # in the DB at a time
+SUMMARY_SOURCES = 100                   # Sources whose summaries are
+                                        # recorded at a time (--summaries)
+ANALYSIS_WORKERS = int(os.environ.get("OSLCRS_ANALYSIS_WORKERS", "1"))
+                                        # Number of analysis programs that
+                                        # may run at the same time
+SCAN_PROCESSES = max(1, len(os.sched_getaffinity(0)) // ANALYSIS_WORKERS)
+                                        # This worker's share of the cores,
+                                        # used for scancode processes
+SHARD_FILES = 20000                     # Files per scancode run, for large
+                                        # packages split into shards
+SHARD_PROCESSES = 4                     # Fewest processes for each shard
+SHARD_FILE_WEIGHT = 4096                # Bytes counted per file when sharding
+DAEMON_POLL = 60                        # Seconds a daemon waits for a
+                                        # notification before looking for
+                                        # work anyway (retries, old claims)
+REPRIORITIZE = 300                      # Seconds between updates of the
+                                        # analysis order
+ESTIMATE_BATCH = 20                     # Sources to find expected sizes for
+                                        # at each of these updates
+ESTIMATE_THREADS = 4                    # ...using this many threads
+BATCH_SOURCES = int(os.environ.get("OSLCRS_BATCH_SOURCES", "50"))
+                                        # Most small sources scanned together
+BATCH_FILES = int(os.environ.get("OSLCRS_BATCH_FILES", "500"))
+                                        # Small means no more files to scan
+BATCH_BYTES = int(os.environ.get("OSLCRS_BATCH_MB", "20")) * 1024 ** 2
+                                        # and no more bytes than these
+BATCH_WAIT = int(os.environ.get("OSLCRS_BATCH_WAIT", "600"))
+                                        # Most seconds a batch is kept
+                                        # waiting for more sources
+CLAIM_TIMEOUT = 24                      # Hours before a claimed source is
+                                        # assumed abandoned by its worker
+PREFETCH = int(os.environ.get("OSLCRS_PREFETCH", "2"))
+                                        # Number of queued sources downloaded
+                                        # while the current one is analyzed
+PREFETCH_BUDGET = int(os.environ.get("OSLCRS_PREFETCH_GB", "20")) * 1024 ** 3
+                                        # Disk space allowed for these
+EXTRACT_CACHE = os.environ.get("OSLCRS_EXTRACT_CACHE", "")
+                                        # Where to keep unpacked trees, if at
+                                        # all, for reanalysis
+EXTRACT_CACHE_BUDGET = int(os.environ.get("OSLCRS_EXTRACT_CACHE_GB", "100")) \
+                       * 1024 ** 3      # Disk space allowed for them
+FETCH_REVALIDATE = "OSLCRS_FETCH_REVALIDATE" in os.environ
+                                        # Check remote archives are unchanged
+                                        # before trusting the fetch cache
+FETCH_LIMIT = int(os.environ.get("OSLCRS_FETCH_LIMIT", "4"))
+                                        # Downloads this worker runs at once
+FETCH_HOST_LIMIT = int(os.environ.get("OSLCRS_FETCH_HOST_LIMIT", "2"))
+                                        # ...and from any one host
+FETCH_ATTEMPTS = 6                      # Tries at a download before giving up
+FETCH_BACKOFF = 5                       # Seconds before retrying a download,
+                                        # doubled for each further try
+PARTIAL_DAYS = 7                        # Unfinished downloads untouched for
+                                        # this long are removed
+FETCH_TIMEOUT = (60, 300)               # Seconds to connect, and to wait for
+                                        # more data
+SCAN_SERVICE = os.environ.get("OSLCRS_SCAN_SERVICE", "")
+                                        # Socket of the scancode service, if
+                                        # it is being used
 ocwd = os.getcwd()                      # Where are we now?
 extractcode = f"{ocwd}/../scancode/extractcode"
 scancode = f"{ocwd}/../scancode/scancode"
@@ -55,61 +167,681 @@ class ldb():                            # License database class
 
 
 # Analysis process level resources.
-# Lock is used to avoid having two copies of the analysis program running at
-# the same time.  Note that this implementation is not very robust, because
-# every time oslcrs runs, it removes and recreates the tmp subdirectory where
+# There are ANALYSIS_WORKERS worker slots, each with its own lockfile, so that
+# at most that many copies of the analysis program run at the same time.  A
+# worker holds the lock for its slot for as long as it runs, and is known to
+# the database by the "worker" name built from the host name and slot number.
+# Each slot also has its own work area on the SCRATCH volume, holding the
+# directory for each source it analyzes and its other working files.
+# Note that this implementation is not very robust, because every time the
+# oslcrs service starts, it removes and recreates the tmp subdirectory where
 # the lockfiles live.  This is a future FIXME.
 class analysis():                       # Analysis class resources
-    global lockfile
-    lockfile = tmpdir + "analysis.lock"
 
-    # Obtain the analysis lock
+    # Obtain the lock for a free worker slot
     def lock():
-        global f
-        f = open(lockfile, 'w+')
-        try:
-            fcntl.flock(f, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        global f, worker, scratchdir, worker_tmp, stagedir, batchdir
+        for slot in range(ANALYSIS_WORKERS):
+            f = open(tmpdir + f"analysis.{slot}.lock", 'w+')
+            try:
+                fcntl.flock(f, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except:
+                f.close()
+                continue                # Slot in use, try the next one
+            worker = f"{socket.gethostname()}:{slot}"
+            scratchdir = SCRATCH + f"/work.{slot}"
+            worker_tmp = scratchdir + "/tmp"
+            stagedir = scratchdir + "/stage"
+            batchdir = scratchdir + "/batch/tree"
             return True                 # Got the lock
-        except:
-            return False                # Failed to obtain lock
+        return False                    # Failed to obtain lock
 
     # Unlock
     def unlock():
         fcntl.flock(f, fcntl.LOCK_UN)
 
+    # Is the worker in a slot still running?
+    def running(slot):
+        with open(tmpdir + f"analysis.{slot}.lock", 'w+') as lf:
+            try:
+                fcntl.flock(lf, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except OSError:
+                return True             # Its lock is held
+            fcntl.flock(lf, fcntl.LOCK_UN)
+            return False
+
+
+# When running as a daemon, wait until we're told there may be new work.
+# Adding to the "sources" table sends an "oslcrs_analysis" notification (see
+# the notify_analysis() trigger function in the database), as does the oslcrs
+# /restart_analysis page.  Notifications are only delivered between
+# transactions, so end the current one first.
+def wait_for_work():
+    ldb.commit()
+    if select.select([ldb.conn], [], [], DAEMON_POLL) != ([], [], []):
+        ldb.conn.poll()
+        ldb.conn.notifies.clear()       # One wake-up covers them all
+
 
 # Compute SWH UUID of a file
-# This code is stolen from the SWH utility that computes UUIDs.  For the
-# record, this code is under GPL-3.0
+# A SWH UUID of type "cnt" is the git blob hash of the file: a sha1 over a
+# "blob <length>" header and a NUL, followed by the file contents.  We used to
+# get this from swh.model, but that reads each file entirely into memory.  Here
+# the file is read HASH_CHUNK bytes at a time.  Like the SWH code, a symbolic
+# link is hashed using the link target rather than whatever it points to.
 def swhid_of_file(path):
-    from swh.model.from_disk import Content
+    if os.path.islink(path):
+        data = os.fsencode(os.readlink(path))
+        sha1 = hashlib.sha1(b"blob %d\0" % len(data))
+        sha1.update(data)
+    else:
+        with open(path, 'rb') as fp:
+            size = os.fstat(fp.fileno()).st_size
+            sha1 = hashlib.sha1(b"blob %d\0" % size)
+            length = 0
+            while True:
+                chunk = fp.read(HASH_CHUNK)
+                if not chunk:
+                    break
+                sha1.update(chunk)
+                length += len(chunk)
+        if length != size:              # File changed while we were reading
+            raise OSError(f"file {path} changed size while being hashed")
+    return "swh:1:cnt:" + sha1.hexdigest()
+
+
+# Compute SWH UUIDs for a list of files, returning them in the same order.
+# Hashing is spread over HASH_WORKERS processes of the worker pool (see where
+# it's started, below).
+def swhids_of_files(paths):
+    paths = list(paths)
+    if len(paths) < HASH_POOL_MIN or HASH_WORKERS < 2:
+        return [swhid_of_file(path) for path in paths]
+    return list(worker_pool.map(swhid_of_file, paths, chunksize=64))
+
+
+# Select the sources that still need analysis, and are not being worked on
+# by some other worker.  A claim older than CLAIM_TIMEOUT is assumed to be left
+# over from a worker that has died.
+analysis_where = f"state != 9 AND retries < {RETRIES} \
+                   AND (claimed IS NULL \
+                        OR claimed < now() - interval '{CLAIM_TIMEOUT} hours')"
+
+
+# Walk a source tree, yielding (path, size) for each regular file, with the
+# path relative to "top".  Symbolic links and other special files are skipped.
+# Files and directories whose paths match the "exclude" regular expression
+# (see load_exclusions()) are skipped as well, without looking inside such
+# directories.  Paths are matched with a leading '/', and directories with a
+# trailing one too, so "/vendor/" matches a top level "vendor" directory.
+# Each of these is added to the "excluded" list, along with the number of
+# files it holds, for the caller to count and remove.
+#
+# FIXME: We ran into a problem where some test code included archives of
+# about 1.2M empty files.  As a temporary workaround, we're going to avoid
+# processing any file that is zero-length or one character long.  This is
+# relatively safe since we can't imagine how copyrightable content could
+# exist in files this short.  These files are removed as they are found.
+def walk_tree(top, exclude=None, excluded=None, prefix=""):
+    with os.scandir(top) as entries:
+        for entry in entries:
+            path = prefix + entry.name
+            if entry.is_dir(follow_symlinks=False):
+                if exclude != None and exclude.search('/' + path + '/'):
+                    excluded.append((path, sum([len(files) for d, s, files
+                                                in os.walk(entry.path)])))
+                    continue
+                yield from walk_tree(entry.path, exclude, excluded,
+                                     path + '/')
+            elif entry.is_file(follow_symlinks=False):
+                if exclude != None and exclude.search('/' + path):
+                    excluded.append((path, 1))
+                    continue
+                size = entry.stat(follow_symlinks=False).st_size
+                if size < TINY_FILE:
+                    os.remove(entry.path)
+                    continue
+                yield path, size
+
+
+# Walk a source tree as above, yielding (path, SWH UUID, size) for each file
+def tree_swhids(top, exclude=None, excluded=None):
+    files = list(walk_tree(top, exclude, excluded))
+    hashes = swhids_of_files([top + '/' + path for path, size in files])
+    for (path, size), file_uuid in zip(files, hashes):
+        yield path, file_uuid, size
+
+
+# Load the path name fragments in the exclude_path table, which mark files
+# that aren't worth analyzing (bundled dependencies, test fixtures and the
+# like).  They're combined into one regular expression, matching any path
+# that contains one of them, or None if there are none.
+def load_exclusions():
+    sql = "SELECT DISTINCT fragment FROM exclude_path WHERE fragment <> '';"
+    try:
+        cdb.execute(sql)
+        rows = cdb.fetchall()
+        ldb.commit()
+    except Exception as e:
+        ldb.rollback()
+        print("Failed to query path exclusions")
+        print("Error: " + e.args[0])
+        ldb.close()
+        exit(1)
+    if len(rows) == 0:
+        return None
+    return re.compile('|'.join([re.escape(row[0]) for row in rows]))
 
-    object = Content.from_file(path=path)
-    return str(object.swhid())
 
+# The order in which sources are analyzed.  Sources are analyzed in priority
+# order, single uploads (priority 1) before bulk imports (priority 0), though
+# the priority of a source can also be set by hand.  Within a priority, the
+# sources needed by releases closest to being complete go first, then the
+# sources expected to be quickest to analyze.  See reprioritize().
+analysis_order = "priority DESC, blocking NULLS LAST, \
+                  NULLIF(est_size, '-1'::bigint) NULLS LAST, id"
 
-# Look to see what analysis work needs to be done.
-# Returns a set of database query rows.
-# WARNING: Ensure analysis_decode() matches the query order.
+
+# Look to see whether any analysis work needs to be done.
+# Returns the number of sources waiting to be claimed.
 def analysis_work():
-    # Fetch sources where analysis != 1000 and retries < RETRIES
-    # FIXME: currently using "9" rather than 1000
-    sql = f"SELECT \
-                id, name, checksum, state, retries, type, fetch_info \
-            FROM sources \
-            WHERE state != 9 and retries < {RETRIES} \
-            ORDER BY id;"
+    sql = f"SELECT count(*) FROM sources WHERE {analysis_where};"
     try:
         cdb.execute(sql)
-        rows = cdb.fetchall()
+        row = cdb.fetchone()
     except Exception as e:
         print("Failed to execute sources analysis list query")
         print("Error: " + e.args[0])
         ldb.close()
         exit(1)
+    return row[0]
+
+
+# Claim up to "count" more sources that need analysis for this worker.  SKIP
+# LOCKED means that several workers claiming at the same moment each get
+# different sources, without waiting for each other.  Returns a list of
+# database rows, in the order they should be analyzed.
+# WARNING: Ensure analysis_decode() matches the query order.
+def claim_work(count):
+    if count < 1:
+        return []
+    sql = f"WITH claim AS ( \
+                UPDATE sources \
+                SET (claimed, worker) = {need_row}(now(), %(worker)s) \
+                WHERE id IN ( \
+                    SELECT id FROM sources \
+                    WHERE {analysis_where} \
+                    ORDER BY {analysis_order} \
+                    LIMIT {count} \
+                    FOR UPDATE SKIP LOCKED) \
+                RETURNING \
+                    id, name, checksum, state, retries, type, fetch_info, \
+                    priority, blocking, est_size) \
+            SELECT * FROM claim ORDER BY {analysis_order};"
+    try:
+        cdb.execute(sql, {"worker": worker})
+        rows = cdb.fetchall()
+        ldb.commit()
+    except Exception as e:
+        ldb.rollback()
+        print("Failed to claim sources for analysis")
+        print("Error: " + e.args[0])
+        ldb.close()
+        exit(1)
     return rows
 
-# Decode a row provided by analysis_work() above.  FIXME: Probably a more clever
+
+# Find the expected archive size for a source that hasn't been fetched, or -1
+# if we can't tell.  This runs in the estimator threads.
+def estimate_size(fetch_url):
+    try:
+        if re.search('^file://', fetch_url):
+            return os.path.getsize(re.sub('^file://', '', fetch_url))
+        r = fetch_session(fetch_url).head(fetch_url, allow_redirects=True,
+                                          timeout=10)
+        return int(r.headers["content-length"])
+    except Exception:
+        return -1
+
+
+# Refresh what the analysis order depends on, at most every REPRIORITIZE
+# seconds.  For each source waiting for analysis, "blocking" is set to the
+# smallest number of packages still missing from any release that lists the
+# source package, directly or through one of its containers (see
+# packages_per_release).  Also, up to ESTIMATE_BATCH sources, next in line,
+# get their expected size found.  That's done in the estimator threads, not
+# the prefetch ones, so as not to wait for downloads to finish, and the sizes
+# are recorded as they come in, on later calls.  The exclude_path rules are
+# loaded again at the same time (see load_exclusions()).
+def reprioritize():
+    global reprioritized, estimates, exclusions
+    done = [e for e in estimates if e[1].done()]
+    for id, future in done:
+        source_update(id, {"est_size": future.result()})
+    estimates = [e for e in estimates if e not in done]
+    if time.time() - reprioritized < REPRIORITIZE:
+        return
+    reprioritized = time.time()
+    exclusions = load_exclusions()
+    sql = "WITH missing AS ( \
+               SELECT release_id, count(*) AS missing \
+               FROM packages_per_release \
+               WHERE NOT EXISTS ( \
+                   SELECT 1 FROM packages \
+                   WHERE packages.nvr = packages_per_release.package_nvr \
+                         AND packages.source = packages_per_release.source) \
+               GROUP BY release_id), \
+           blocks AS ( \
+               SELECT sources.id, min(missing.missing) AS blocking \
+               FROM sources \
+               LEFT JOIN packages_per_release ON package_nvr = \
+                   regexp_replace(sources.name, '\\.src\\.rpm$', '') \
+               LEFT JOIN missing USING (release_id) \
+               WHERE sources.state != 9 \
+               GROUP BY sources.id) \
+           UPDATE sources SET blocking = blocks.blocking \
+           FROM blocks \
+           WHERE sources.id = blocks.id AND \
+                 sources.blocking IS DISTINCT FROM blocks.blocking;"
+    try:
+        cdb.execute(sql)
+        cdb.execute(f"SELECT id, fetch_info FROM sources \
+                      WHERE {analysis_where} AND est_size IS NULL \
+                            AND type != 'scnt' \
+                      ORDER BY {analysis_order} \
+                      LIMIT {ESTIMATE_BATCH};")
+        rows = cdb.fetchall()
+        ldb.commit()
+    except Exception as e:
+        ldb.rollback()
+        print("Failed to reprioritize the analysis queue")
+        print("Error: " + e.args[0])
+        ldb.close()
+        exit(1)
+    if len(estimates) > 0:
+        return                          # Still working on the last lot
+    for row in rows:
+        fetch_url = json.loads(row[1]).get('fetch_url', '')
+        estimates.append((row[0], estimator.submit(estimate_size, fetch_url)))
+
+
+# Give up a source claimed by this worker, or all of them if no id is given
+def release_claims(id=None):
+    sql = f"UPDATE sources SET (claimed, worker) = {need_row}(NULL, NULL) \
+            WHERE worker = %(worker)s"
+    if id != None:
+        sql += f" AND id = {id}"
+    try:
+        cdb.execute(sql, {"worker": worker})
+        ldb.commit()
+    except Exception as e:
+        ldb.rollback()
+        print("Failed to release claimed sources")
+        print("Error: " + e.args[0])
+        ldb.close()
+        exit(1)
+
+
+# Download state shared by the threads fetching sources.  At most FETCH_LIMIT
+# downloads run at once, and at most FETCH_HOST_LIMIT from any one host.  Each
+# thread keeps a keep-alive session for each host it fetches from, as
+# sessions aren't safe to share between threads.
+fetch_slots = threading.BoundedSemaphore(FETCH_LIMIT)
+fetch_host_slots = dict()               # Host name -> its semaphore
+fetch_lock = threading.Lock()           # Protects fetch_host_slots
+fetch_local = threading.local()         # Sessions for each thread
+
+
+# Get this thread's session for the host a URL refers to
+def fetch_session(fetch_url):
+    host = urllib.parse.urlsplit(fetch_url).netloc
+    sessions = getattr(fetch_local, "sessions", None)
+    if sessions == None:
+        sessions = fetch_local.sessions = dict()
+    if host not in sessions:
+        sessions[host] = requests.Session()
+        sessions[host].verify = False   # As with wget --no-check-certificate
+    return sessions[host]
+
+
+# Get the semaphore limiting the downloads from one host
+def fetch_host_slot(fetch_url):
+    host = urllib.parse.urlsplit(fetch_url).netloc
+    with fetch_lock:
+        if host not in fetch_host_slots:
+            fetch_host_slots[host] = \
+                threading.BoundedSemaphore(FETCH_HOST_LIMIT)
+        return fetch_host_slots[host]
+
+
+# A download failed in a way that trying again may fix
+class fetch_retry(Exception):
+    pass
+
+
+# Make one try at downloading a URL into the partial file "part".  If part of
+# the archive is already there, from an earlier try (or an earlier analysis
+# run), only the rest is asked for.  The response headers of the first try
+# are kept alongside in "part.headers", so that "If-Range" makes the server
+# send the whole archive again if it has changed since.
+#
+# The SWH UUID is computed as the archive arrives, as long as the server says
+# how big it is; the part already on disk is read back to start the hash.
+# Returns the headers and the UUID (None if it wasn't computed).  Raises
+# fetch_retry, or one of the requests or urllib3 exceptions, for errors worth
+# retrying, and returns an "error" for those that aren't.
+def fetch_attempt(fetch_url, part):
+    with open(part, 'ab') as fp:
+        try:
+            fcntl.flock(fp, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except OSError:
+            raise fetch_retry("being fetched by another worker")
+        have = os.fstat(fp.fileno()).st_size
+        headers = dict()
+        if have > 0 and os.path.isfile(part + ".headers"):
+            try:
+                with open(part + ".headers") as hp:
+                    headers = json.load(hp)
+            except ValueError:          # Cut short by a worker that died,
+                fp.truncate(0)          # so start again from the beginning
+                os.remove(part + ".headers")
+                have = 0
+        request = dict()
+        if have > 0:
+            request["Range"] = f"bytes={have}-"
+            validator = headers.get("etag", "")
+            if validator == "" or validator.startswith("W/"):
+                validator = headers.get("last-modified", "")
+            if validator != "":
+                request["If-Range"] = validator
+
+        # Ask for the archive, and check that we got what we asked for
+        r = fetch_session(fetch_url).get(fetch_url, headers=request,
+                                         stream=True, timeout=FETCH_TIMEOUT)
+        with r:
+            if r.status_code == 429 or r.status_code >= 500:
+                raise fetch_retry(f"HTTP {r.status_code} {r.reason}")
+            if r.status_code == 416 and have > 0:
+                fp.truncate(0)          # Start again from the beginning
+                raise fetch_retry("partial download no longer valid")
+            if r.status_code == 206:
+                m = re.match(r'bytes (\d+)-\d+/(\d+|\*)',
+                             r.headers.get("content-range", ""))
+                if m == None or int(m.group(1)) != have:
+                    fp.truncate(0)
+                    raise fetch_retry("unexpected range returned")
+                total = int(m.group(2)) if m.group(2) != '*' else None
+            elif r.status_code == 200:
+                have = 0
+                fp.truncate(0)
+                headers = {name: r.headers[name] for name in
+                           ("etag", "last-modified", "content-length")
+                           if name in r.headers}
+                with open(part + ".headers", 'w') as hp:
+                    json.dump(headers, hp)
+                total = r.headers.get("content-length")
+                total = int(total) if total != None else None
+            else:
+                if have == 0:
+                    os.remove(part)     # Don't leave an empty one behind
+                return {"error": f"HTTP {r.status_code} {r.reason}"}
+
+            # Hash what we already have, then the rest as it arrives.  The
+            # archive is saved as sent, so no Content-Encoding is undone.
+            sha1 = None
+            if total != None:
+                sha1 = hashlib.sha1(b"blob %d\0" % total)
+                with open(part, 'rb') as old:
+                    for chunk in iter(lambda: old.read(HASH_CHUNK), b''):
+                        sha1.update(chunk)
+            for chunk in r.raw.stream(HASH_CHUNK, decode_content=False):
+                fp.write(chunk)
+                if sha1 != None:
+                    sha1.update(chunk)
+        fp.flush()
+        size = os.fstat(fp.fileno()).st_size
+        if total != None and size != total:
+            raise fetch_retry(f"connection closed after {size} of " +
+                              f"{total} bytes")
+    headers["content-length"] = str(size)
+    return {"error": "", "headers": headers,
+            "uuid": "swh:1:cnt:" + sha1.hexdigest() if sha1 != None else None}
+
+
+# The partial download of a URL, in partdir
+def fetch_part(fetch_url):
+    return partdir + '/' + hashlib.sha1(bytes(fetch_url, 'UTF-8')).hexdigest()
+
+
+# Remove the partial download of a URL, once its source won't be tried again
+def fetch_discard(fetch_url):
+    part = fetch_part(fetch_url)
+    for path in (part, part + ".headers"):
+        try:
+            os.remove(path)
+        except FileNotFoundError:
+            pass
+
+
+# Remove partial downloads nobody has touched for PARTIAL_DAYS days.  They
+# belong to sources that were deleted, or gave up in some way that didn't
+# go through fetch_discard(), and would otherwise fill the scratch volume, as
+# no budget counts them.  Those being downloaded (and so locked) are left.
+def fetch_expire():
+    cutoff = time.time() - PARTIAL_DAYS * 24 * 3600
+    for name in os.listdir(partdir):
+        part = partdir + '/' + re.sub(r'\.headers$', '', name)
+        try:
+            if os.path.getmtime(partdir + '/' + name) > cutoff:
+                continue
+            with open(part, 'ab') as fp:
+                fcntl.flock(fp, fcntl.LOCK_EX | fcntl.LOCK_NB)
+                for path in (part, part + ".headers"):
+                    if os.path.exists(path):
+                        os.remove(path)
+        except OSError:
+            pass                        # In use, or already gone
+
+
+# Fetch a source archive into "destdir", which should be empty, and compute
+# its SWH UUID.  This runs in the prefetch threads, so it must not use the
+# database; errors are handed back to be logged by the caller.  Returns a
+# dictionary with the archive name and UUID, or the error details, along with
+# the "stages" it took to get them (see record_stage()).
+#
+# Remote archives are downloaded in-process (see fetch_attempt()) into
+# partdir, named after the URL, so that a failed download picks up where it
+# left off, both here and when the source is next tried.  Failures are
+# retried FETCH_ATTEMPTS times, waiting FETCH_BACKOFF seconds, then twice as
+# long each time.
+def fetch_source(fetch_url, destdir):
+    result = {"error": "", "stages": []}
+    started = stage_time()
+    if re.search('^file://', fetch_url):
+        result["retry"] = False         # No need to retry
+        output = subprocess.run(["cp", re.sub('^file://', '', fetch_url), '.'],
+                                cwd=destdir, capture_output=True)
+        if output.returncode != 0:
+            result["error"] = "failed source file copy"
+            result["stderr"] = str(output.stderr, 'UTF-8')
+            return result
+        result["headers"] = dict()
+        try:
+            result["archive"] = [f for f in os.listdir(destdir)
+                                 if os.path.isfile(destdir + '/' + f)][0]
+            archive = destdir + '/' + result["archive"]
+            size = os.path.getsize(archive)
+            result["stages"].append({"stage": "download", "started": started,
+                                     "ended": stage_time(), "files": 1,
+                                     "size": size})
+            started = stage_time()
+            result["uuid"] = swhid_of_file(archive)
+            result["stages"].append({"stage": "swhid", "started": started,
+                                     "ended": stage_time(), "files": 1,
+                                     "size": size})
+        except Exception as e:
+            result["error"] = "failed to checksum fetched source"
+            result["stderr"] = str(e)
+        return result
+
+    # Download a remote archive
+    result["retry"] = True              # This could benefit from a retry
+    name = urllib.parse.unquote(
+               os.path.basename(urllib.parse.urlsplit(fetch_url).path))
+    if name in ("", ".", ".."):
+        name = "index.html"             # The name wget would have used
+    part = fetch_part(fetch_url)
+    errors = []
+    for attempt in range(FETCH_ATTEMPTS):
+        if attempt > 0:
+            time.sleep(FETCH_BACKOFF * 2 ** (attempt - 1))
+        try:
+            with fetch_slots, fetch_host_slot(fetch_url):
+                fetched = fetch_attempt(fetch_url, part)
+        except (fetch_retry, requests.RequestException,
+                urllib3.exceptions.HTTPError, OSError) as e:
+            errors.append(f"try {attempt + 1}: {e}")
+            continue
+        if fetched["error"] != "":
+            errors.append(f"try {attempt + 1}: {fetched['error']}")
+            break                       # Trying again won't help
+        try:
+            os.rename(part, destdir + '/' + name)
+            if os.path.isfile(part + ".headers"):
+                os.remove(part + ".headers")
+            size = os.path.getsize(destdir + '/' + name)
+            result["stages"].append({"stage": "download", "started": started,
+                                     "ended": stage_time(), "files": 1,
+                                     "size": size})
+            if fetched["uuid"] == None: # Size wasn't known in advance
+                started = stage_time()
+                fetched["uuid"] = swhid_of_file(destdir + '/' + name)
+                result["stages"].append({"stage": "swhid",
+                                         "started": started,
+                                         "ended": stage_time(), "files": 1,
+                                         "size": size})
+        except OSError as e:
+            result["error"] = "failed to checksum fetched source"
+            result["stderr"] = str(e)
+            return result
+        result["archive"] = name
+        result["uuid"] = fetched["uuid"]
+        result["headers"] = fetched["headers"]
+        return result
+    result["error"] = "failed source URL fetch"
+    result["stderr"] = '\n'.join(errors)
+    return result
+
+
+# Have we already analyzed a source archive fetched from this URL?  This
+# allows resubmitted sources to be dealt with before downloading anything.
+# Returns the archive SWH UUID, or None if it must be fetched.
+#
+# URLs are trusted to always return the same archive.  If FETCH_REVALIDATE is
+# set, the headers recorded with the fetch are checked with a HEAD request
+# first, and any difference means fetching the archive again.
+def fetch_cache_lookup(fetch_url):
+    if re.search('^file://', fetch_url):
+        return None                     # Local files are never cached
+    sql = "SELECT fetch_cache.checksum, etag, last_modified, content_length \
+           FROM fetch_cache \
+           WHERE fetch_url = %(fetch_url)s AND EXISTS ( \
+               SELECT 1 FROM sources \
+               WHERE sources.checksum = fetch_cache.checksum \
+                     AND sources.state = 9);"
+    try:
+        cdb.execute(sql, {"fetch_url": fetch_url})
+        row = cdb.fetchone()
+        ldb.commit()
+    except Exception as e:
+        ldb.rollback()
+        print("Failed to execute fetch cache query")
+        print("Error: " + e.args[0])
+        ldb.close()
+        exit(1)
+    if row == None:
+        return None
+    if FETCH_REVALIDATE:
+        try:
+            r = fetch_session(fetch_url).head(fetch_url,
+                                              allow_redirects=True,
+                                              timeout=FETCH_TIMEOUT)
+        except Exception:
+            return None
+        if r.status_code != 200:
+            return None
+        for name, value in (("etag", row[1]), ("last-modified", row[2]),
+                            ("content-length", row[3])):
+            if value != None and r.headers.get(name) != str(value):
+                return None
+    return row[0].rstrip()
+
+
+# Remember the archive fetched from a URL, for fetch_cache_lookup()
+def fetch_cache_add(fetch_url, fetched):
+    if re.search('^file://', fetch_url):
+        return
+    headers = fetched["headers"]
+    sql = "INSERT INTO fetch_cache \
+               (fetch_url, checksum, etag, last_modified, content_length) \
+           VALUES (%(fetch_url)s, %(checksum)s, %(etag)s, %(last_modified)s, \
+                   %(content_length)s) \
+           ON CONFLICT (fetch_url) DO UPDATE SET \
+               (checksum, etag, last_modified, content_length, fetched) = \
+               (EXCLUDED.checksum, EXCLUDED.etag, EXCLUDED.last_modified, \
+                EXCLUDED.content_length, now());"
+    params = {"fetch_url": fetch_url,
+              "checksum": fetched["uuid"],
+              "etag": headers.get("etag"),
+              "last_modified": headers.get("last-modified"),
+              "content_length": headers.get("content-length")}
+    try:
+        cdb.execute(sql, params)
+        ldb.commit()
+    except Exception as e:
+        ldb.rollback()
+        print("Failed to add to the fetch cache")
+        print("Error: " + e.args[0])
+        ldb.close()
+        exit(1)
+
+
+# Total size of the prefetched archives in the staging area
+def staged_bytes():
+    total = 0
+    for dirpath, dirnames, filenames in os.walk(stagedir):
+        for name in filenames:
+            try:
+                total += os.lstat(dirpath + '/' + name).st_size
+            except OSError:
+                pass                    # Removed while we were looking
+    return total
+
+
+# Start downloading queued sources into the staging area, while there's room.
+# Each queue entry is a list of [database row, prefetch future].  The disk
+# budget is checked before each download starts, as we don't know archive
+# sizes ahead of time, so the budget can be overrun by the downloads in
+# flight.
+def prefetch_queue(queue):
+    for entry in queue:
+        if entry[1] != None:
+            continue                    # Already being fetched
+        w = analysis_decode(entry[0])
+        if w['type'] == "scnt":
+            continue                    # Source containers aren't fetched
+        if staged_bytes() >= PREFETCH_BUDGET:
+            break
+        fetch_url = json.loads(w['fetch_info'])['fetch_url']
+        if fetch_cache_lookup(fetch_url) != None:
+            continue                    # Won't need to be fetched
+        destdir = stagedir + '/' + str(w['id'])
+        if not os.path.isdir(destdir):
+            os.mkdir(destdir)
+        entry[1] = prefetcher.submit(fetch_source, fetch_url, destdir)
+
+
+# Decode a row provided by claim_work() above.  FIXME: Probably a more clever
 # way to do this.
 def analysis_decode(row):
     w = dict()
@@ -120,18 +852,13 @@ def analysis_decode(row):
     w["retries"] = row[4]
     w["type"] = row[5]
     w["fetch_info"] = row[6]
+    w["priority"] = row[7]
     return w
 
 
 # Update a source analysis.  This code will update all the items passed to
 # it in the "params" dictionary parameter.
 def source_update(id, params):
-    # Issue
-    if int(db_version[0]) > 9:
-        need_row = "ROW"
-    else:
-        need_row = ""
-
     sql = "UPDATE sources SET ("
     sql += ", ".join(params.keys())
     sql += f") = {need_row}(%("
@@ -142,6 +869,7 @@ def source_update(id, params):
         cdb.execute(sql, params)
         ldb.commit()
     except Exception as e:
+        ldb.rollback()
         print(f"Failed to update sources table with analysis status:")
         print(params)
         print("Error: " + e.args[0])
@@ -149,45 +877,69 @@ def source_update(id, params):
         exit(1)
 
 
-# Have we already analyzed a specific file?
+# Have we already analyzed any of a set of files?
 # FIXME: This function may change when we take into account scancode versions.
-# Returns file id if we already have license data for this file, or else None.
-def isfile_done(uuid):
-    sql = f"SELECT id FROM files WHERE swh = '{uuid}';"
-    try:
-        cdb.execute(sql)
-        rows = cdb.fetchall()
-    except Exception as e:
-        print("Failed to execute files uuid query")
-        print("Error: " + e.args[0])
-        ldb.close()
-        exit(1)
-    if len(rows) > 0:
-        return rows[0][0]
-    else:
-        return None
+# Large packages contain hundreds of thousands of files, and one query per file
+# costs more in DB round trips than the scancode run itself.  So the UUIDs are
+# looked up FILE_BATCH at a time, each batch as a single array query.
+# Returns a dictionary of file ids, indexed by UUID, holding only those files
+# we already have license data for.
+def files_done(uuids):
+    uuids = list(uuids)
+    done = dict()
+    sql = "SELECT swh, id FROM files \
+           WHERE swh = ANY(%(uuids)s::character(50)[]);"
+    for i in range(0, len(uuids), FILE_BATCH):
+        try:
+            cdb.execute(sql, {"uuids": uuids[i:i + FILE_BATCH]})
+            rows = cdb.fetchall()
+        except Exception as e:
+            print("Failed to execute files uuid query")
+            print("Error: " + e.args[0])
+            ldb.close()
+            exit(1)
+        for row in rows:
+            done[row[0].rstrip()] = row[1]
+    return done
 
 
-# Add a file that we've analyzed
-def addfile(uuid):
-    sql = f"INSERT INTO files (swh) VALUES ('{uuid}') \
-            RETURNING id;"
-    try:
-        cdb.execute(sql)
-        ldb.commit()
-        row = cdb.fetchone()
-        return(row[0])
-    except Exception as e:
-        print("Failed to add to the files table")
-        print("Error: " + e.args[0])
-        ldb.close()
-        exit(1)
+# Add the files that we've analyzed, FILE_BATCH at a time.  Returns a
+# dictionary of the new file ids, indexed by UUID.  Note that nothing is
+# committed here; see bulk_load() below.
+#
+# Another worker may have added some of the same files since we looked them
+# up with files_done(), as the files of a package are only added as its scan
+# results arrive.  The unique index on "swh" makes such an insert wait for
+# the other worker's transaction, and then return the id it added instead.
+# Recording the scan results again for these files does no harm, as they're
+# loaded with bulk_load(), which ignores duplicates.
+def addfiles(uuids):
+    uuids = list(uuids)
+    added = dict()
+    sql = "INSERT INTO files (swh) \
+           SELECT unnest(%(uuids)s::character(50)[]) \
+           ON CONFLICT (swh) DO UPDATE SET swh = EXCLUDED.swh \
+           RETURNING swh, id;"
+    for i in range(0, len(uuids), FILE_BATCH):
+        try:
+            cdb.execute(sql, {"uuids": uuids[i:i + FILE_BATCH]})
+            rows = cdb.fetchall()
+        except Exception as e:
+            ldb.rollback()
+            print("Failed to add to the files table")
+            print("Error: " + e.args[0])
+            ldb.close()
+            exit(1)
+        for row in rows:
+            added[row[0].rstrip()] = row[1]
+    return added
 
 
 # Add to a table, where we don't need an id back.  This is a general routine
 # that works on several tables.  Please note that this routine currently
 # ignores the insert if it violates a table constraint.  This may be a FIXME.
-def addrow(table, params):
+# Pass commit=False when the row is part of a larger transaction.
+def addrow(table, params, commit=True):
     sql = f"INSERT INTO {table} ("
     sql += ", ".join(params.keys())
     sql += ") VALUES (%("
@@ -195,14 +947,147 @@ def addrow(table, params):
     sql += ")s) ON CONFLICT DO NOTHING;"
     try:
         cdb.execute(sql, params)
-        ldb.commit()
+        if commit:
+            ldb.commit()
     except Exception as e:
+        ldb.rollback()
         print(f"Failed to add a row to the {table} table")
         print("Error: " + e.args[0])
         ldb.close()
         exit(1)
 
 
+# The time now, as recorded in the analysis_stages table
+def stage_time():
+    return datetime.datetime.now(datetime.timezone.utc)
+
+
+# Record one stage of the analysis of a source in the analysis_stages table:
+# when it started and ended, how many files and bytes it dealt with, and the
+# CPU seconds and peak memory of the child processes it ran, where known.
+# Like the rest of the analysis, this is committed with the next status
+# update.  The global "source_id" is used unless another id is given.
+def record_stage(stage, started, ended=None, files=None, size=None, cpu=None,
+                 rss=None, id=None):
+    addrow("analysis_stages",
+           {
+             "source_id": source_id if id == None else id,
+             "stage": stage,
+             "worker": worker,
+             "started": started,
+             "ended": ended if ended != None else stage_time(),
+             "files": files,
+             "bytes": size,
+             "cpu_seconds": cpu,
+             "max_rss": rss
+           }, commit=False)
+
+
+# Format one value for a COPY, using the PostgreSQL text format
+def copy_value(value):
+    if value is None:
+        return "\\N"
+    value = str(value)
+    value = value.replace("\\", "\\\\")
+    value = value.replace("\t", "\\t")
+    value = value.replace("\n", "\\n")
+    value = value.replace("\r", "\\r")
+    return value
+
+
+# Bulk add many rows to a table.  A package can have hundreds of thousands of
+# license detections, copyrights and paths, and an INSERT plus commit for each
+# is far too slow.  Instead, the rows are streamed into a temporary staging
+# table with COPY, then merged into the real table with a single statement.
+# Like addrow(), rows violating a table constraint are ignored.
+#
+# Nothing is committed here.  The caller commits once the whole package is
+# recorded, so that a package is never seen half-ingested by the reports.
+# "rows" is a list of tuples in "columns" order.
+def bulk_load(table, columns, rows):
+    if len(rows) == 0:
+        return
+    stage = f"stage_{table}"
+    cols = ", ".join(columns)
+    buf = io.StringIO()
+    for row in rows:
+        buf.write("\t".join([copy_value(v) for v in row]) + "\n")
+    buf.seek(0)
+    try:
+        cdb.execute(f"CREATE TEMP TABLE IF NOT EXISTS {stage} \
+                      (LIKE {table} INCLUDING DEFAULTS) ON COMMIT DROP;")
+        cdb.copy_expert(f"COPY {stage} ({cols}) FROM STDIN", buf)
+        cdb.execute(f"INSERT INTO {table} ({cols}) \
+                      SELECT {cols} FROM {stage} \
+                      ON CONFLICT DO NOTHING;")
+        cdb.execute(f"TRUNCATE {stage};")
+    except Exception as e:
+        ldb.rollback()
+        print(f"Failed to bulk load rows into the {table} table")
+        print("Error: " + e.args[0])
+        ldb.close()
+        exit(1)
+
+
+# Record the distinct copyright statements found in each of a list of
+# sources, in the source_copyrights table, replacing what was there.  The
+# reports look them up there (through the package_copyrights view), rather
+# than collecting them from every file of every package each time.  This is
+# done as each source's paths are recorded, and covers the files pruned as
+# already known, whose copyrights were recorded with an earlier source.
+# Nothing is committed here, as for bulk_load().
+def record_copyrights(source_ids):
+    ids = ", ".join([str(id) for id in source_ids])
+    try:
+        cdb.execute(f"DELETE FROM source_copyrights \
+                      WHERE source_id IN ({ids});")
+        cdb.execute(f"INSERT INTO source_copyrights (source_id, copyright) \
+                      SELECT paths.source_id, \
+                             string_agg(DISTINCT copyrights.copyright, \
+                                        E'\\n' ORDER BY copyrights.copyright) \
+                      FROM paths \
+                      JOIN copyrights ON copyrights.file_id = paths.file_id \
+                      WHERE paths.source_id IN ({ids}) \
+                      GROUP BY paths.source_id;")
+    except Exception as e:
+        ldb.rollback()
+        print("Failed to record source copyrights")
+        print("Error: " + e.args[0])
+        ldb.close()
+        exit(1)
+
+
+# Record how often each license is detected in each of a list of sources,
+# and its best score, in the source_licenses table, replacing what was there.
+# The license pages add these up for the packages of a release or container,
+# instead of going through every detection in every file.  This counts
+# detections, not files: a file with several detections of a license counts
+# once for each of them, and again for each path it's at, as the pages have
+# always counted.  As above, this is done as the paths are recorded, and
+# nothing is committed.
+def record_licenses(source_ids):
+    ids = ", ".join([str(id) for id in source_ids])
+    try:
+        cdb.execute(f"DELETE FROM source_licenses \
+                      WHERE source_id IN ({ids});")
+        cdb.execute(f"INSERT INTO source_licenses \
+                             (source_id, lic_name, detections, max_score) \
+                      SELECT paths.source_id, license_detects.lic_name, \
+                             COUNT(license_detects.file_id), \
+                             MAX(license_detects.score) \
+                      FROM paths \
+                      JOIN license_detects ON license_detects.file_id = \
+                                              paths.file_id \
+                      WHERE paths.source_id IN ({ids}) \
+                      GROUP BY paths.source_id, license_detects.lic_name;")
+    except Exception as e:
+        ldb.rollback()
+        print("Failed to record source licenses")
+        print("Error: " + e.args[0])
+        ldb.close()
+        exit(1)
+
+
 # Vacuum the database, something that needs to be done occassionally
 # FIXME: This code doesn't work, errors on the "SET AUTOCOMMIT" statement.
 # It's not currently in use, but left in the code in case it's necessary in
@@ -224,45 +1109,675 @@ def vacuum():
 
 
 # Clean the temporary source analysis subdirectory.  This gets done a lot, so
-# keep all the code here.
+# keep all the code here.  Any scratch space reserved for it is given back.
 def clean_temp():
-    os.chdir(tmpdir)
-    output = subprocess.run(["/bin/rm", "-rf", pkgdir], capture_output=True)
-    if output.returncode != 0:
+    os.chdir(scratchdir)
+    try:
+        shutil.rmtree(pkgdir)
+    except OSError as e:
         print("error: failed to remove package analysis subdirectory")
-        print(str(output.stderr, 'UTF-8'))
+        print(e)
+        exit(1)
+    scratch_release()
+    scratch_release("memory")
+
+
+# Estimate the scratch space needed to unpack an archive.  Zip archives list
+# the size of each member, and gzip keeps the unpacked size (modulo 4GB) at
+# the end, which is believed for archives too small to have wrapped it.  For
+# anything else, or if the metadata can't be read, the unpacked size is
+# taken to be SCRATCH_RATIO times the archive size.  Archives nested inside
+# are unpacked too, so this is only a first guess for those.
+def scratch_needed(archive):
+    size = os.path.getsize(archive)
+    try:
+        if zipfile.is_zipfile(archive):
+            with zipfile.ZipFile(archive) as z:
+                return sum([i.file_size for i in z.infolist()])
+        with open(archive, 'rb') as fp:
+            if fp.read(2) == b'\x1f\x8b' and size < 2 ** 28:
+                fp.seek(-4, os.SEEK_END)
+                unpacked = int.from_bytes(fp.read(4), 'little')
+                if unpacked >= size:
+                    return unpacked
+    except Exception:
+        pass
+    return size * SCRATCH_RATIO
+
+
+# Scratch space or memory reserved by the workers that are running (other
+# than this one), from the "scratch" or "memory" files in their work areas.
+def worker_reserved(kind):
+    total = 0
+    for name in os.listdir(SCRATCH):
+        m = re.match(r'work\.(\d+)$', name)
+        if m == None or SCRATCH + '/' + name == scratchdir:
+            continue
+        try:
+            with open(SCRATCH + '/' + name + '/' + kind) as fp:
+                reserved = int(fp.read())
+        except (OSError, ValueError):
+            continue                    # Nothing reserved
+        if analysis.running(int(m.group(1))):
+            total += reserved
+    return total
+
+
+# Reserve scratch space before unpacking a source, waiting while the other
+# workers have too much of it reserved.  Their reservations are counted in
+# full, even though some of the space is already in use (and so missing from
+# what the filesystem says is free), which errs on the safe side.  Space that
+# would never be enough, even once the other workers have given back all they
+# have reserved, isn't waited for.  Returns True once reserved, or False if
+# there'll never be enough.
+def scratch_reserve(need):
+    waiting = False
+    while True:
+        with open(SCRATCH + "/reserve.lock", 'w') as lf:
+            fcntl.flock(lf, fcntl.LOCK_EX)
+            st = os.statvfs(SCRATCH)
+            free = st.f_bavail * st.f_frsize - SCRATCH_FREE
+            others = worker_reserved("scratch")
+            if need <= free - others:
+                with open(scratchdir + "/scratch", 'w') as fp:
+                    fp.write(str(need))
+                return True
+        if need > free + others:
+            return False                # Not even with the others done
+        if not waiting:
+            print(f"Waiting for {need // 1024 ** 2}MB of scratch space")
+            source_update(source_id, {"status": "Waiting for scratch space"})
+            waiting = True
+        time.sleep(SCRATCH_WAIT)
+
+
+# Give back this worker's scratch space (or memory) reservation
+def scratch_release(kind="scratch"):
+    try:
+        os.remove(scratchdir + '/' + kind)
+    except FileNotFoundError:
+        pass
+
+
+# Memory the kernel thinks can be used without swapping, in bytes
+def memory_available():
+    with open("/proc/meminfo") as fp:
+        for line in fp:
+            if line.startswith("MemAvailable:"):
+                return int(line.split()[1]) * 1024
+    return 0
+
+
+# Fit a model of the resources scancode needs to recent history, in the
+# analysis_stages table.  The peak memory of a scancode process is taken to
+# grow linearly with the number of files scanned, and the CPU time with the
+# number of bytes.  A batched scan is recorded against each of its sources,
+# so duplicates are removed first.  This is refitted every REPRIORITIZE
+# seconds.
+def fit_resources():
+    global resource_model, resources_fitted
+    if time.time() - resources_fitted < REPRIORITIZE:
+        return
+    resources_fitted = time.time()
+    sql = f"SELECT regr_intercept(max_rss, files), \
+                   regr_slope(max_rss, files), \
+                   max(max_rss), \
+                   regr_intercept(cpu_seconds, bytes), \
+                   regr_slope(cpu_seconds, bytes) \
+            FROM (SELECT DISTINCT worker, started, files, bytes, \
+                         cpu_seconds, max_rss \
+                  FROM analysis_stages \
+                  WHERE stage = 'scan' AND max_rss IS NOT NULL \
+                  ORDER BY started DESC LIMIT {MEMORY_HISTORY}) AS recent;"
+    try:
+        cdb.execute(sql)
+        resource_model = cdb.fetchone()
+        ldb.commit()
+    except Exception as e:
+        ldb.rollback()
+        print("Failed to fit the resource model")
+        print("Error: " + e.args[0])
+        ldb.close()
+        exit(1)
+
+
+# Predict the peak memory of each scancode process, and the CPU seconds of the
+# whole scan, for a scan of "files" files holding "size" bytes.  Until there's
+# enough history to fit, the largest peak seen so far, or MEMORY_DEFAULT, is
+# used for the memory, and the CPU time is unknown (None).
+def predict_resources(files, size):
+    rss_a, rss_b, rss_max, cpu_a, cpu_b = resource_model
+    if rss_a != None and rss_b != None:
+        rss = max(rss_a + rss_b * files, 0)
+    elif rss_max != None:
+        rss = rss_max
+    else:
+        rss = MEMORY_DEFAULT
+    cpu = None
+    if cpu_a != None and cpu_b != None:
+        cpu = max(cpu_a + cpu_b * size, 0)
+    return int(rss * MEMORY_MARGIN), cpu
+
+
+# Decide how many scancode processes a scan of "files" files holding "size"
+# bytes can have without the host running out of memory, and reserve the
+# memory for them.  As many as will fit in what's available, up to
+# SCAN_PROCESSES, are used.  If not even one will fit, we wait while other
+# workers have memory reserved; if none do, one process is used anyway.
+# As for scratch space, the reservations of other workers are counted in
+# full, even though their scans are using some of it already.  While waiting,
+# the sources to be scanned, "ids", say so.
+def memory_reserve(files, size, ids):
+    per_process, cpu = predict_resources(files, size)
+    print(f"Predicted {per_process // 1024 ** 2}MB per scancode process" +
+          (f", {cpu:.0f} CPU seconds" if cpu != None else ""))
+    waiting = False
+    while True:
+        with open(SCRATCH + "/reserve.lock", 'w') as lf:
+            fcntl.flock(lf, fcntl.LOCK_EX)
+            others = worker_reserved("memory")
+            processes = min(SCAN_PROCESSES,
+                            (memory_available() - others) // per_process)
+            if processes >= 1 or others == 0:
+                processes = max(processes, 1)
+                with open(scratchdir + "/memory", 'w') as fp:
+                    fp.write(str(processes * per_process))
+                return processes
+        if not waiting:
+            print("Waiting for memory to scan in")
+            for id in ids:
+                source_update(id, {"status": "Waiting for memory"})
+            waiting = True
+        time.sleep(SCRATCH_WAIT)
+
+
+# CPU seconds used by the child processes of this program (and theirs) that
+# have finished so far
+def children_cpu():
+    usage = resource.getrusage(resource.RUSAGE_CHILDREN)
+    return usage.ru_utime + usage.ru_stime
+
+
+# Remove this worker's work area.  This is done when the program exits, for
+# whatever reason, as well as when it starts, in case the last worker in this
+# slot was killed before it could.
+def scratch_cleanup():
+    os.chdir(SCRATCH)
+    shutil.rmtree(scratchdir, ignore_errors=True)
+
+
+# Log a command error to the database, counting it as a failed try.  We use
+# the global "source_id" to know where to log any error messages and the value
+# of "retries" to keep count of failures.
+def log_error(err, stderr):
+    error_str = "error: "
+    if err != "":
+        error_str += err
+    error_str += '\n'
+    error_str += stderr
+    print(error_str)
+    p = {"error": error_str, "retries": str(retries + 1)}
+    sql = f"UPDATE sources \
+            SET (error, retries) = (%(error)s, %(retries)s) \
+            WHERE id = {source_id}"
+    try:
+        cdb.execute(sql, p)
+        ldb.commit()
+    except Exception as e:
+        ldb.rollback()
+        print(f"error: failed to log error to DB for source id {source_id}")
+        print("Error: " + e.args[0])
         exit(1)
 
 
 # Run a command, log errors to the database, and return a True (error) or
 # False (successful command) to the caller.
 def cmd(cmd, err):
-    # We use the global "source_id" to know where to log any error messages
-    # and the value of "retries" to keep count of failures.  The value of
-    # "pkgdir" is used to clean tempfiles.
+    # The value of "pkgdir" is used to clean tempfiles.
     output = subprocess.run(cmd, capture_output=True)
     if output.returncode == 0:
         return False
     else:
-        error_str = "error: "
+        log_error(err, str(output.stderr, 'UTF-8'))
+        return True
+
+
+# Compute an integer version related to the scancode version, recorded with
+# each result as the "detector"
+def scancode_detector(headers):
+    detector = 0
+    for i in headers[0]["tool_version"].split('.'):
+        detector = detector * 1000 + int(i)
+    return detector
+
+
+# Record license and copyright results for a batch of scanned files.  New
+# files get their "files" table entry as their first results arrive, and
+# "file_adds" is updated with the ids.  As with bulk_load(), nothing is
+# committed here.
+def record_scan(scfs, detector, uuids, file_adds):
+    new = [uuids[scf['path']] for scf in scfs
+           if file_adds[uuids[scf['path']]] is None]
+    file_adds.update(addfiles(dict.fromkeys(new)))  # Same file may appear
+                                                    # at several paths
+    license_rows = []
+    copyright_rows = []
+    for scf in scfs:
+        # print(f"Results for file {scf['path']}")
+        # print(f"SWH UUID: {uuids[scf['path']]}")
+        fid = file_adds[uuids[scf['path']]]
+        # print(f"DB id was {fid}")
+        for lic in scf["licenses"]:
+            # print(f"License {lic['key']}, score {lic['score']}, " +
+            #       f"rule {lic['matched_rule']['identifier']}, " +
+            #       f"start {lic['start_line']} end {lic['end_line']}")
+
+            ###
+            # FIXME WARNING
+            #
+            # Early in its use of scancode, the PELC team found that
+            # certain license detections were seen, but these detections
+            # are not useful.  Although scancode is detecting "something",
+            # it's not an actionable result.  We decided that these would
+            # be ignored.  Due to this, these detections were dropped
+            # before they became part of the result database, as well
+            # as not being present in the licenses table.  This is not a
+            # good long-term strategy.  It would be better to record the
+            # detection, but then filter it out upon presentation to the
+            # user.  However, this will take more work on the reporting
+            # side.
+            #
+            # For now, I am following the PELC example of skipping the
+            # recording of these license detections.  However, we will
+            # need to change how we handle these in the future, as well
+            # as rescan *all* the packages/files that we have in the DB,
+            # in order to update the detection results.
+            ###
+            if lic['key'] == 'unknown-license-reference':
+                continue                # Skip adding this license detection
+            license_rows.append((fid, lic['key'], lic['score'],
+                                 lic['matched_rule']['identifier'],
+                                 lic['start_line'], lic['end_line'],
+                                 detector))
+        for copy in scf["copyrights"]:
+            # print(f"Copyright: {copy['value']}")
+            copyright_rows.append((fid, copy['value'],
+                                   copy['start_line'], copy['end_line'],
+                                   detector))
+    bulk_load("license_detects",
+              ["file_id", "lic_name", "score", "rule", "start_line",
+               "end_line", "detector"],
+              license_rows)
+    bulk_load("copyrights",
+              ["file_id", "copyright", "start_line", "end_line", "detector"],
+              copyright_rows)
+
+
+# Split the files of a large package into shards to be scanned side by side.
+# "files" is a list of (path, size) for the files to be scanned.  The number
+# of shards depends on the number of files, but each shard gets at least
+# SHARD_PROCESSES of our cores.  Files are dealt out largest first, each to
+# the shard with the least work so far, counting a file's work as its size
+# plus SHARD_FILE_WEIGHT for the per-file overhead.  Returns a list of path
+# lists, or None if the package should be scanned in one shot.
+def plan_shards(files, processes):
+    shards = min(-(-len(files) // SHARD_FILES),
+                 processes // SHARD_PROCESSES)
+    if shards < 2:
+        return None
+    work = [(0, n) for n in range(shards)]
+    plan = [[] for n in range(shards)]
+    for path, size in sorted(files, key=lambda f: f[1], reverse=True):
+        total, n = heapq.heappop(work)
+        plan[n].append(path)
+        heapq.heappush(work, (total + size + SHARD_FILE_WEIGHT, n))
+    return plan
+
+
+# A scan run by the scancode service (see scancode-service.py), made to look
+# enough like a scancode process for scan_and_record().  The service sends
+# the same output as scancode, then a final status line, which is held back
+# here and turned into a return code, along with the resources the scan used.
+class scan_client():
+    def __init__(self, root, processes, efp):
+        self.returncode = None
+        self.usage = (None, None)
+        self.efp = efp
+        self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self.sock.connect(SCAN_SERVICE)
+        job = {"root": os.path.abspath(root), "processes": processes}
+        self.sock.sendall(bytes(json.dumps(job) + '\n', 'UTF-8'))
+        self.stdout = self.lines()
+
+    def lines(self):
+        with self.sock.makefile('r', encoding='UTF-8') as rfile:
+            for line in rfile:
+                if line.startswith('{"scan_status"'):
+                    status = json.loads(line)["scan_status"]
+                    self.efp.write(status["errors"])
+                    self.efp.flush()
+                    self.returncode = 0 if status["success"] else 1
+                    self.usage = (status.get("cpu"), status.get("rss"))
+                else:
+                    yield line
+        self.sock.close()
+
+    def wait(self):
+        if self.returncode == None:     # Lost the service part way through
+            self.returncode = 1
+        return self.returncode
+
+    def kill(self):
+        try:
+            self.sock.shutdown(socket.SHUT_RDWR)
+        except OSError:
+            pass
+
+
+# Start scancode on the tree at "root", writing JSON Lines to its "stdout"
+# and errors to "efp".  The scancode service is used if there is one running,
+# else a new scancode process.
+def start_scan(root, processes, efp):
+    if SCAN_SERVICE != "" and os.path.exists(SCAN_SERVICE):
+        try:
+            return scan_client(root, processes, efp)
+        except OSError as e:
+            print(f"Failed to reach the scancode service: {e}")
+    return subprocess.Popen([scancode, "-plc", "--quiet",
+                             "--json-lines", "-",
+                             "--only-findings", "--strip-root",
+                             "--processes", str(processes),
+                             "--timeout", "0",
+                             "--max-depth", "0", root],
+                            stdout=subprocess.PIPE, stderr=efp, text=True)
+
+
+# Wait for a scan to finish, returning its exit status, and the CPU seconds
+# and peak memory (in bytes) of scancode and the processes it started
+def scan_wait(scan):
+    if isinstance(scan, scan_client):
+        return (scan.wait(),) + scan.usage
+    pid, status, usage = os.wait4(scan.pid, 0)
+    scan.returncode = os.waitstatus_to_exitcode(status)
+    return (scan.returncode, usage.ru_utime + usage.ru_stime,
+            usage.ru_maxrss * 1024)
+
+
+# Hand each line of a scancode run's output to the main thread, followed by
+# None when the run finishes.  If the output can't be read (the scancode
+# service connection is reset, say), the exception is handed over before the
+# None, so that the scan fails rather than leaving the main thread waiting.
+def read_scan(stdout, lines):
+    try:
+        for line in stdout:
+            lines.put(line)
+    except Exception as e:
+        lines.put(e)
+    finally:
+        lines.put(None)
+
+
+# Run scancode over the current directory, recording results as they arrive.
+# Scancode writes JSON Lines to a pipe: a headers line first, then one line
+# per file.  Each line is parsed on its own and results are recorded
+# INGEST_BATCH files at a time, so memory use doesn't grow with the size of
+# the package.  Returns the error output if the scan failed, having rolled
+# back anything recorded so far, or "" if all went well.
+#
+# Up to "processes" scancode processes are used (see memory_reserve()).  The
+# times taken are added to "stages" (see record_stage()): "scan" lasts until
+# the last scancode process is done, with the CPU time of all of them and the
+# largest peak memory of any, and "ingest" from when the first results are
+# recorded until the last are.
+#
+# Large packages are split by plan_shards(), with the files of each shard hard
+# linked into a "../shard.<n>" tree at the same relative paths.  The shards
+# are scanned at the same time, sharing out our cores, and their output is
+# merged into one stream.  Since each run strips its root, result paths are
+# the same as for a single run over the whole tree.
+def scan_and_record(uuids, file_adds, files, stages, processes):
+    started = stage_time()
+    ingest_started = None
+    recorded = 0
+    plan = plan_shards(files, processes)
+    if plan == None:
+        roots = ['.']
+    else:
+        roots = []
+        for n, paths in enumerate(plan):
+            root = f"../shard.{n}"
+            for path in paths:
+                os.makedirs(os.path.dirname(root + '/' + path), exist_ok=True)
+                os.link(path, root + '/' + path)
+            roots.append(root)
+        print(f"Scanning {len(files)} files in {len(roots)} shards")
+    processes = max(1, processes // len(roots))
+
+    lines = Queue(maxsize=INGEST_BATCH)
+    scans = []
+    for n, root in enumerate(roots):
+        efp = open(f"../scancode.{n}.err", "w")
+        scan = start_scan(root, processes, efp)
+        threading.Thread(target=read_scan, args=(scan.stdout, lines),
+                         daemon=True).start()
+        scans.append((scan, efp))
+
+    detector = None
+    batch = []
+    err = ""
+    running = len(scans)
+    while running > 0:
+        line = lines.get()
+        if line == None:
+            running -= 1
+            if running == 0:
+                scanned = stage_time()
+            continue
         if err != "":
-            error_str += err
-        error_str += '\n'
-        error_str += str(output.stderr, 'UTF-8')
-        print(error_str)
-        p = {"error": error_str, "retries": str(retries + 1)}
-        sql = f"UPDATE sources \
-                SET (error, retries) = (%(error)s, %(retries)s) \
-                WHERE id = {source_id}"
+            continue                    # Just draining output after an error
+        if isinstance(line, Exception):
+            for scan, efp in scans:
+                scan.kill()
+            err = f"failed to read scancode output: {line}\n"
+            continue
         try:
-            cdb.execute(sql, p)
-            ldb.commit()
-        except Exception as e:
-            ldb.rollback()
-            print(f"error: failed to log error to DB for source id {source_id}")
-            print("Error: " + e.args[0])
-            exit(1)
-        return True
+            sc = json.loads(line)
+            if "headers" in sc:
+                detector = scancode_detector(sc["headers"])
+                # print(f"Detector: {detector}")
+            for scf in sc.get("files", []):
+                if scf["type"] == "file":
+                    batch.append(scf)
+                else:
+                    # print(f"Would ignore {scf['path']}, " +
+                    #       f"type {scf['type']}")
+                    pass                # Python NOOP
+            if len(batch) >= INGEST_BATCH:
+                if ingest_started == None:
+                    ingest_started = stage_time()
+                record_scan(batch, detector, uuids, file_adds)
+                recorded += len(batch)
+                batch = []
+        except ValueError as e:         # Includes JSON decode errors
+            for scan, efp in scans:
+                scan.kill()
+            err = f"bad scancode output: {e}\n"
+    if err == "":
+        if ingest_started == None:
+            ingest_started = stage_time()
+        record_scan(batch, detector, uuids, file_adds)
+        recorded += len(batch)
+        ingested = stage_time()
+    cpu = 0
+    rss = 0
+    for scan, efp in scans:
+        returncode, scan_cpu, scan_rss = scan_wait(scan)
+        if returncode != 0 and err == "":
+            err = f"scancode exit status {returncode}\n"
+        efp.close()
+        cpu = cpu + scan_cpu if cpu != None and scan_cpu != None else None
+        rss = max(rss, scan_rss) if rss != None and scan_rss != None else None
+    if err == "":
+        size = sum([size for path, size in files])
+        stages.append({"stage": "scan", "started": started,
+                       "ended": scanned, "files": len(files), "size": size,
+                       "cpu": cpu, "rss": rss})
+        stages.append({"stage": "ingest", "started": ingest_started,
+                       "ended": ingested, "files": recorded})
+        return ""
+    ldb.rollback()                      # Discard any partial results
+    for n in range(len(roots)):
+        with open(f"../scancode.{n}.err") as efp:
+            err += efp.read()
+    return err
+
+
+# Record the rest of a source's analysis, once its files have been scanned
+# and their results recorded: file paths, binary packages, and the "sources"
+# entry, all committed together.  "pend" holds what was learned about the
+# source in the main loop, and "file_adds" the new files and their ids.  The
+# caller must have set the global "source_id" and "retries" for this source.
+def finish_source(pend, file_adds):
+    source_id = pend["id"]
+
+    # Files without findings still need a "files" table entry
+    file_adds.update(addfiles([swh_uuid for swh_uuid, fid in file_adds.items()
+                               if fid is None]))
+
+
+    # Record all file paths in the "paths" table.  Every UUID is either one
+    # we looked up before pruning, or one we just added to the files table.
+    started = stage_time()
+    file_ids = pend["file_ids"]
+    file_ids.update(file_adds)
+    bulk_load("paths", ["source_id", "file_id", "path"],
+              [(source_id, file_ids[value], key)
+               for key, value in pend["uuids"].items()])
+    record_copyrights([source_id])
+    record_licenses([source_id])
+    record_stage("paths", started, files=len(pend["uuids"]), id=source_id)
+
+
+    # Now that source analysis is done, we need to add the binary packages
+    # FIXME: Error checks?  Duplicates?  The current code will simply replace
+    # existing nvr values with new ones.  This is *not* desired.  We *hope* to
+    # not have duplicate nvr values, as these will make it difficult/impossible
+    # to refer to packages by nvr, but if/when there is a duplicate, we need
+    # to detect it and decide what to do about it.
+    for binary in pend["binaries"]:
+        addrow("packages",
+               {
+                 "nvr": binary['nvr'],
+                 "source_id": source_id,
+                 "sum_license": binary['license']
+               }, commit=False)
+    # One last special case, and this is probably a future FIXME!
+    # We have imported source packages, yet this system is designed to produce
+    # reports indexed by binary packages.  (After all, that's what we ship,
+    # right?)  Yet, depending on the way the manifest data is handed to us and
+    # the customer desires, we may want to index these license reports based on
+    # source packages.  We could have a lot of duplicate reporting code (and we
+    # might want to do this in the future for full flexibility), but since this
+    # is a prototype, I'm trying a short-cut, to see how well it works.
+    #
+    # We've already added the specified binary packages.  We will ALSO add
+    # another binary package and set a flag so we know it's not a real binary
+    # package, but one corresponding to the source package name.  Doing this
+    # means that the reporting code can simply search on package names and not
+    # have to handle special cases.  Yet, these extra entries are flagged in
+    # case we want to eliminate them later.  Here's the code that adds these
+    # fake binary packages.
+    addrow("packages",
+           {
+             "nvr": pend["src_pkg_name"],
+             "source_id": source_id,
+             "sum_license": pend["pkg_sum_license"],
+             "source": 1
+           }, commit=False)
+    # END fake binary package FIXME
+
+
+    # We need to record the upstream URL in the sources table.  The value comes
+    # from earlier, when we gathered metadata from the source archive or else
+    # it was provided to us.  Also record package checksum and mark scancode
+    # as being "done".  Do not clear "error", because unpack errors may need to
+    # be reviewed.  This update commits everything recorded above.
+    source_update(source_id, {"url": pend["upstream_url"],
+                              "status": "scancode analysis complete",
+                              "checksum": pend["pkg_uuid"],
+                              "excluded": pend["excluded"], "state": "9"})
+
+
+    # If we were analyzing a local file, now is the time to remove that file
+    # so we don't run out of server space.  Recall that we saved src_loc
+    # earlier for this purpose.
+    src_loc = pend["src_loc"]
+    if src_loc != "":
+        if cmd(["rm", src_loc],
+               f"failed to remove already-analyzed file {src_loc}"):
+            return
+        # Try to remove the subdirectory this file was in, in case it's now
+        # empty.
+        cmdstr = f'rmdir --ignore-fail-on-non-empty "`dirname {src_loc}`"'
+        if cmd(["/bin/bash", "-c", cmdstr],
+               f"failed to remove subdir of already-analyzed file {src_loc}"):
+            return
+
+
+# Scan the batch of small packages that has been collected, then finish each
+# of them.  Each source's tree is under "<source_id>/" in batchdir, so the
+# scan results are split back out by this path prefix.  Files are shared by
+# all the sources, so a file found in several of them is only added once.
+# Other sources may have been analyzed since these were set aside, so the
+# files still to be scanned are looked up again, and those now known are
+# pruned as they would have been in the first place.  If the scan fails,
+# each source is charged with a retry, and will then be analyzed on its own.
+# The scan and ingest stages recorded for each source are those of the whole
+# batch.
+def finish_batch(batch):
+    global source_id, retries
+    uuids = dict()                      # SWH UUIDs indexed by prefixed path
+    file_adds = dict()                  # New files, shared by the batch
+    scan_files = []
+    done = files_done(dict.fromkeys([pend["uuids"][path] for pend in batch
+                                     for path, size in pend["scan_files"]]))
+    for pend in batch:
+        prefix = str(pend["id"]) + '/'
+        for path, file_uuid in pend["uuids"].items():
+            uuids[prefix + path] = file_uuid
+        for path, size in pend["scan_files"]:
+            file_uuid = pend["uuids"][path]
+            if file_uuid in done:
+                pend["file_ids"][file_uuid] = done[file_uuid]
+                os.remove(batchdir + '/' + prefix + path)
+            else:
+                file_adds[file_uuid] = None
+                scan_files.append((prefix + path, size))
+    print(f"Scanning a batch of {len(batch)} packages")
+    processes = memory_reserve(len(scan_files),
+                               sum([size for path, size in scan_files]),
+                               [pend["id"] for pend in batch])
+    for pend in batch:
+        source_update(pend["id"], {"status": "Scancode license/copyright " +
+                                             "analysis (batched)"})
+    os.chdir(batchdir)
+    stages = []
+    err = scan_and_record(uuids, file_adds, scan_files, stages, processes)
+    scratch_release("memory")
+    for pend in batch:
+        source_id = pend["id"]
+        retries = pend["retries"]
+        if err != "":
+            log_error("failed batched scancode license/copyright analysis",
+                      err)
+        else:
+            for stage in stages:
+                record_stage(**stage)
+            finish_source(pend, file_adds)
+        release_claims(source_id)
+    os.chdir(scratchdir)
+    shutil.rmtree(os.path.dirname(batchdir), ignore_errors=True)
+    os.makedirs(batchdir)
 
 
 # Locates a spec file in the top level of the unpacked subdirectory, then
@@ -343,71 +1858,396 @@ def parse_spec_file(pkg_name):      # Get metadata from spec file
     return summary
 
 
+# The extraction cache holds unpacked and pruned source trees, indexed by
+# archive SWH UUID, so that reanalysis of a package doesn't need to unpack it
+# again.  Each tree is in a subdirectory named by the UUID, with its size in
+# bytes in a "<UUID>.size" file next to it.  Trees are hard linked in and out
+# of the cache where possible, which is safe since the analysis only ever
+# removes files from its copy.  The cache is shared by all workers, so entries
+# are added with a rename and may disappear at any time.
+def tree_copy(src, dst):
+    def link_or_copy(src, dst):
+        try:
+            os.link(src, dst)
+        except OSError:
+            shutil.copy2(src, dst)
+    shutil.copytree(src, dst, symlinks=True, copy_function=link_or_copy)
+
+
+# Copy a cached tree to "dest".  Returns True if we had one.
+def extract_cache_get(uuid, dest):
+    if EXTRACT_CACHE == "":
+        return False
+    entry = EXTRACT_CACHE + '/' + uuid
+    try:
+        tree_copy(entry, dest)
+        os.utime(entry)                 # Recently used
+        return True
+    except OSError:
+        shutil.rmtree(dest, ignore_errors=True)
+        return False
+
+
+# Add the tree in "src" to the cache, then trim the cache back down to its
+# budget, least recently used trees first
+def extract_cache_put(uuid, src):
+    if EXTRACT_CACHE == "":
+        return
+    entry = EXTRACT_CACHE + '/' + uuid
+    partial = entry + f".{os.getpid()}.partial"
+    size = 0
+    try:
+        tree_copy(src, partial)
+        for dirpath, dirnames, filenames in os.walk(partial):
+            for name in filenames:
+                size += os.lstat(dirpath + '/' + name).st_size
+        with open(entry + ".size", 'w') as ofp:
+            ofp.write(str(size))
+        os.rename(partial, entry)
+    except OSError as e:
+        print(f"Failed to add {uuid} to the extraction cache: {e}")
+        shutil.rmtree(partial, ignore_errors=True)
+        return
+
+    entries = []
+    total = 0
+    for name in os.listdir(EXTRACT_CACHE):
+        if not name.endswith(".size"):
+            continue
+        entry = EXTRACT_CACHE + '/' + name[:-5]
+        try:
+            with open(entry + ".size") as ifp:
+                size = int(ifp.read())
+            entries.append((os.stat(entry).st_mtime, entry, size))
+        except (OSError, ValueError):
+            continue                    # Being added or removed elsewhere
+        total += size
+    for mtime, entry, size in sorted(entries):
+        if total <= EXTRACT_CACHE_BUDGET:
+            break
+        shutil.rmtree(entry, ignore_errors=True)
+        try:
+            os.remove(entry + ".size")
+        except OSError:
+            pass
+        total -= size
+
+
+# Archives we unpack ourselves, by name, and those left to extractcode
+extract_tar = re.compile(r'\.(tar|tar\.gz|tgz|tar\.bz2|tbz2?|tar\.xz|txz|' +
+                         r'tar\.lzma|tlz)$', re.IGNORECASE)
+extract_zip = re.compile(r'\.(zip|jar|war|ear|whl|egg)$', re.IGNORECASE)
+extract_stream = {".gz": gzip.open, ".bz2": bz2.open, ".xz": lzma.open,
+                  ".lzma": lzma.open}
+extract_other = re.compile(r'\.(rpm|deb|7z|cpio|rar|cab|zst|gem|crate)$',
+                           re.IGNORECASE)
+
+
+# An archive went over one of the EXTRACT_* limits
+class extract_limit(Exception):
+    pass
+
+
+# Keep count of what's unpacked from one archive, stopping at the limits.
+# The ratio limit only applies once EXTRACT_RATIO_MIN bytes are unpacked, so
+# that small archives of very repetitive files aren't stopped.
+class extract_budget():
+    def __init__(self, archive):
+        self.packed = os.path.getsize(archive)
+        self.members = 0
+        self.bytes = 0
+
+    def member(self):
+        self.members += 1
+        if self.members > EXTRACT_MEMBERS:
+            raise extract_limit(f"more than {EXTRACT_MEMBERS} members")
+
+    def add(self, size):
+        self.bytes += size
+        if self.bytes > EXTRACT_BYTES:
+            raise extract_limit(f"more than {EXTRACT_BYTES} bytes unpacked")
+        if self.bytes > EXTRACT_RATIO_MIN and \
+           self.bytes > self.packed * EXTRACT_RATIO:
+            raise extract_limit("unpacks to more than " +
+                                f"{EXTRACT_RATIO} times its size")
+
+
+# Where an archive member goes under "dest", or None if its name would put
+# it anywhere else
+def extract_path(dest, name):
+    parts = [p for p in name.replace('\\', '/').split('/')
+             if p not in ('', '.')]
+    if len(parts) == 0 or '..' in parts:
+        return None
+    return os.path.join(dest, *parts)
+
+
+# Whether "path" really is inside "dest", once the symbolic links already
+# unpacked there are followed.  Looking at the names alone isn't enough: a
+# link to ".." inside a link to "../.." can reach anywhere.  The deepest part
+# of the path that exists is resolved, as the rest will be created as plain
+# directories under it.
+def extract_inside(dest, path):
+    top = os.path.realpath(dest)
+    while not os.path.lexists(path):
+        path = os.path.dirname(path)
+    path = os.path.realpath(path)
+    return path == top or path.startswith(top + '/')
+
+
+# Whether a member can be written at "path": its directory must be inside
+# "dest" (see extract_inside()), and nothing is written through a symbolic
+# link already there
+def extract_writable(dest, path):
+    return extract_inside(dest, os.path.dirname(path)) and \
+           not os.path.islink(path)
+
+
+# Copy a member's contents to "path", counting them against the budget as
+# they're written, as archive headers can't be trusted about sizes.  Files
+# turning out to be tiny are removed again.
+def extract_copy(src, path, budget):
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    size = 0
+    with open(path, 'wb') as dst:
+        for chunk in iter(lambda: src.read(HASH_CHUNK), b''):
+            budget.add(len(chunk))
+            dst.write(chunk)
+            size += len(chunk)
+    if size < TINY_FILE:
+        os.remove(path)
+
+
+# Unpack a tar archive (compressed or not) into "dest".  Only directories,
+# regular files and links staying inside "dest" are unpacked (see
+# extract_writable()), and files too short to hold anything copyrightable
+# are skipped.  A hard link names a member unpacked before it, which is
+# copied.
+def extract_tar_archive(archive, dest, budget):
+    with tarfile.open(archive, 'r:*') as tf:
+        for m in tf:
+            budget.member()
+            path = extract_path(dest, m.name)
+            if path == None or not extract_writable(dest, path):
+                continue
+            if m.isdir():
+                os.makedirs(path, exist_ok=True)
+            elif m.isfile() and m.size >= TINY_FILE:
+                extract_copy(tf.extractfile(m), path, budget)
+            elif m.issym():
+                target = os.path.join(os.path.dirname(path), m.linkname)
+                if os.path.isabs(m.linkname) or os.path.lexists(path) or \
+                   not extract_inside(dest, target):
+                    continue
+                os.makedirs(os.path.dirname(path), exist_ok=True)
+                os.symlink(m.linkname, path)
+            elif m.islnk():
+                target = extract_path(dest, m.linkname)
+                if target in (None, path) or \
+                   not extract_inside(dest, target) or \
+                   os.path.islink(target) or not os.path.isfile(target):
+                    continue
+                with open(target, 'rb') as src:
+                    extract_copy(src, path, budget)
+
+
+# Unpack a zip archive into "dest", as above.  The central directory says
+# what's in the archive, so the limits are checked before starting.
+def extract_zip_archive(archive, dest, budget):
+    with zipfile.ZipFile(archive) as z:
+        infos = z.infolist()
+        for i in infos:
+            budget.member()
+            budget.add(i.file_size)
+        budget.bytes = 0
+        for i in infos:
+            path = extract_path(dest, i.filename)
+            if path == None or not extract_writable(dest, path):
+                continue
+            if i.is_dir():
+                os.makedirs(path, exist_ok=True)
+            elif i.file_size >= TINY_FILE:
+                with z.open(i) as src:
+                    extract_copy(src, path, budget)
+
+
+# Unpack a single compressed file into "dest", under its name without the
+# compression suffix
+def extract_stream_file(archive, dest, budget):
+    name, suffix = os.path.splitext(os.path.basename(archive))
+    budget.member()
+    with extract_stream[suffix.lower()](archive, 'rb') as src:
+        extract_copy(src, dest + '/' + name, budget)
+
+
+# Check a tree that extractcode has unpacked against the budget, as it
+# can't be stopped part way.  Symbolic links leading out of the tree are
+# removed, as we do for the archives we unpack ourselves.
+def extract_check_tree(dest, budget):
+    for dirpath, dirnames, filenames in os.walk(dest):
+        for name in dirnames + filenames:
+            path = dirpath + '/' + name
+            budget.member()
+            if os.path.islink(path):
+                if not extract_inside(dest, path):
+                    os.remove(path)
+            elif name in filenames:
+                budget.add(os.lstat(path).st_size)
+
+
+# Unpack one archive, replacing it with a directory of the same name holding
+# its contents, as "extractcode --replace-originals" does.  Archives of kinds
+# we don't unpack ourselves are given to extractcode, without letting it
+# unpack anything nested inside (we do that, see extract_nested()), and what
+# it unpacks is checked against the same limits afterwards.  This runs in
+# the extraction processes.  Returns "" on success, or an error message.  An
+# archive over the limits is left as it is, to be scanned as a file, while a
+# damaged one is replaced with whatever could be unpacked.
+def extract_archive(archive):
+    name = os.path.basename(archive)
+    suffix = os.path.splitext(name)[1].lower()
+    budget = extract_budget(archive)
+    if not (extract_tar.search(name) or extract_zip.search(name) or
+            suffix in extract_stream):
+        dest = archive + "-extract"     # Where extractcode puts it
+        output = subprocess.run([extractcode, "--shallow", archive],
+                                capture_output=True)
+        err = ""
+        if output.returncode != 0:
+            err = f"{name}: extractcode failed\n" + \
+                  str(output.stderr, 'UTF-8')
+        if not os.path.isdir(dest) or len(os.listdir(dest)) == 0:
+            shutil.rmtree(dest, ignore_errors=True)
+            return err
+        try:
+            extract_check_tree(dest, budget)
+        except extract_limit as e:
+            shutil.rmtree(dest, ignore_errors=True)
+            return f"{name}: not unpacked, {e}"
+        os.remove(archive)
+        os.rename(dest, archive)
+        return err
+
+    dest = archive + ".oslcrs-extract"
+    try:
+        os.mkdir(dest)
+        if extract_tar.search(name):
+            extract_tar_archive(archive, dest, budget)
+        elif extract_zip.search(name):
+            extract_zip_archive(archive, dest, budget)
+        else:
+            extract_stream_file(archive, dest, budget)
+        err = ""
+    except extract_limit as e:
+        shutil.rmtree(dest, ignore_errors=True)
+        return f"{name}: not unpacked, {e}"
+    except Exception as e:
+        err = f"{name}: {e}"
+        if len(os.listdir(dest)) == 0:
+            shutil.rmtree(dest, ignore_errors=True)
+            return err
+    os.remove(archive)
+    os.rename(dest, archive)
+    return err
+
+
+# Find the archives in a tree that are still to be unpacked
+def extract_find(top):
+    for dirpath, dirnames, filenames in os.walk(top):
+        for name in filenames:
+            path = dirpath + '/' + name
+            if os.path.islink(path):
+                continue
+            suffix = os.path.splitext(name)[1].lower()
+            if extract_tar.search(name) or extract_zip.search(name) or \
+               suffix in extract_stream or extract_other.search(name):
+                yield path
+
+
+# Unpack the archives nested inside an unpacked tree, and those nested in
+# them, up to EXTRACT_DEPTH levels down.  The archives found at each level
+# are independent of each other, so they're unpacked at the same time, by
+# the worker pool, keeping to this worker's share of SCAN_PROCESSES of its
+# processes.  Returns a list of error messages.
+def extract_nested(top):
+    errors = []
+    dirs = [top]
+    for depth in range(EXTRACT_DEPTH):
+        archives = [path for d in dirs for path in extract_find(d)]
+        if len(archives) == 0:
+            break
+        dirs = []
+        running = dict()                # Archive being unpacked, by future
+        while len(archives) > 0 or len(running) > 0:
+            while len(archives) > 0 and len(running) < SCAN_PROCESSES:
+                path = archives.pop(0)
+                running[worker_pool.submit(extract_archive, path)] = path
+            done, pending = wait(running, return_when=FIRST_COMPLETED)
+            for future in done:
+                path = running.pop(future)
+                err = future.result()
+                if err != "":
+                    errors.append(err)
+                if os.path.isdir(path):
+                    dirs.append(path)   # Look inside it next time round
+    else:
+        errors.append(f"archives nested more than {EXTRACT_DEPTH} " +
+                      "levels deep were not unpacked")
+    return errors
+
+
 # Unpacks a source archive
 #
-# This code used to be essentially a one-liner.  However, in practice, we find
-# that unpack failures are pretty common, and that we need to separate a
-# complete failure of unpack (which means we can't do any license analysis)
-# from cases where just a few files failed to unpack, perhaps because the
-# source was corrupt, and it's reasonable to proceed with license analysis.
-# On top of this, we want to capture diagnostic output, so that we know
-# a) what we analyzed and b) can feed back failures to upstream projects.
+# This code used to be essentially a one-liner, running extractcode over the
+# whole archive.  However, in practice, we find that unpack failures are
+# pretty common, and that we need to separate a complete failure of unpack
+# (which means we can't do any license analysis) from cases where just a few
+# files failed to unpack, perhaps because the source was corrupt, and it's
+# reasonable to proceed with license analysis.  On top of this, we want to
+# capture diagnostic output, so that we know a) what we analyzed and b) can
+# feed back failures to upstream projects.
+#
+# extractcode also unpacked one archive at a time, and would unpack anything,
+# however big.  We've seen a test archive that held 1.2M empty files
+# (zip64support.tar.bz2 in apache-commons-compress), which used to be removed
+# again after unpacking.  So the common formats are now unpacked here, with
+# limits for each archive (see extract_budget()), skipping tiny files, and
+# nested archives are unpacked in parallel.  extractcode is only used for the
+# other formats (RPMs, in particular).
 # Return code is 0 for success (proceed with license analysis) or 1 to quit.
 def unpack_archive(pkgdir, pkgname):
     archive = pkgdir + '/' + pkgname
-    # FIXME: A few comments on the lines below:
-    # 1) It's nice to use --quiet in scripts, but at least at one point
-    #    in the development, --quiet threw away all errors.  We need to
-    #    see the error messages to know what didn't get unpacked.
-    # 2) I'd love to use --all-formats, so that we unpack as much as we
-    #    can.  But almost immediately, unpack failed on .patch files.  I
-    #    don't know what's up with that, and didn't have time to investigate.
-    # 3) I *really* need to use --replace-originals so that we don't try to
-    #    scan both the archive files and also the extracted files.  Also,
-    #    I'd rather not inject extra "-extract" characters into the file paths.
-    #    However, extractcode has been buggy.  First, it would crash due to
-    #    https://github.com/nexB/scancode-toolkit/issues/2723  This was fixed
-    #    upstream, but the new code still doesn't work right.  As of this
-    #    writing, I have my own patch to extractcode, but this needs to be
-    #    worked out with upstream.
-    # 4) I've seen one case where a test archive was built that contains
-    #    bunches, actually 1.2M, empty files.  The specific case is in
-    #    apache-commons-compress, an archive called zip64support.tar.bz2
-    #    in a test subdirectory.  We may wish to have a list of archives
-    #    that should not be unpacked, and extractcode provides a
-    #    --ignore option for this purpose.  However, be aware that other
-    #    files that happen to match this name would then be ignored.
-    # if cmd([extractcode, "--quiet", "--all-formats", "--replace-originals",
-    if cmd([extractcode, "--replace-originals", archive],
-           "source code extraction output:"):
-        # Here, we need to determine whether the failure was complete, or
-        # whether it's useful to continue with scancode analysis.  We could
-        # look at the extractcode output that got logged to the DB, but then
-        # we'd be sensitive to any upstream changes in that output.  Instead,
-        # the bottom line is whether the main archive itself has been
-        # converted into a subdirectory and now contains at least one file.
-        # This is an easy test.
-        try:
-            topdir = os.listdir(pkgdir + '/' + pkgname)
-            # print(topdir)
-            if len(topdir) < 1:
-                returncode = 1          # Failed to unpack (don't try to scan)
-            else:
-                returncode = 0          # Successful unpack
-        except:
-            returncode = 1              # Failed to unpack
-    else:
-        returncode = 0                  # Successful unpack
+    errors = []
+    err = extract_archive(archive)
+    if err != "":
+        errors.append(err)
+    if os.path.isdir(archive):
+        errors += extract_nested(archive)
+    if len(errors) > 0:
+        log_error("source code extraction output:", '\n'.join(errors))
+
+    # Here, we need to determine whether the failure was complete, or whether
+    # it's useful to continue with scancode analysis.  The bottom line is
+    # whether the main archive itself has been converted into a subdirectory
+    # and now contains at least one file.  This is an easy test.
+    try:
+        topdir = os.listdir(archive)
+        # print(topdir)
+        if len(topdir) < 1:
+            returncode = 1              # Failed to unpack (don't try to scan)
+        else:
+            returncode = 0              # Successful unpack
+    except:
+        returncode = 1                  # Failed to unpack
 
     # Yet another extractcode problem: It's leaving temporary subdirectories
-    # under /tmp.  Normally, they're very small and don't cause trouble, but
+    # under $TMPDIR.  Normally, they're very small and don't cause trouble, but
     # sometimes the sizes can be substantial.  These can fill the disk and
-    # bring the system down.  Try to remove them.
-    tmpdirs = os.listdir("/tmp")
-    for tmpdir in tmpdirs:
-        if tmpdir[0:12] == "scancode-tk-":
-            cmd(["rm", "-rf", "/tmp/" + tmpdir],
-                "removing extractcode tmp files:")
+    # bring the system down.  Try to remove them.  Only this worker's
+    # temporary subdirectory is cleaned, as other workers may be running.
+    for name in os.listdir(worker_tmp):
+        if name[0:12] == "scancode-tk-":
+            shutil.rmtree(worker_tmp + '/' + name, ignore_errors=True)
 
     return returncode
 
@@ -418,10 +2258,23 @@ def unpack_archive(pkgdir, pkgname):
 #
 
 
+# Run once, analyzing whatever is waiting, or as a daemon?
+parser = argparse.ArgumentParser(description="Analyze queued source packages")
+parser.add_argument("--daemon", action="store_true",
+                    help="keep running, waiting for sources to be queued")
+parser.add_argument("--summaries", action="store_true",
+                    help="record the copyright and license summaries of " +
+                         "analyzed sources that have none, then exit")
+args = parser.parse_args()
+
+
 # Do we have a temporary directory?  Error out if we don't.
 if not os.path.isdir(tmpdir):
     print(f"Missing temporary subdirectory {tmpdir} (needed for analysis work)")
     exit(1)
+if not os.path.isdir(SCRATCH):
+    print(f"Missing scratch subdirectory {SCRATCH} (needed for analysis work)")
+    exit(1)
 
 
 # Connect to the database.  We can't do anything without a connection.
@@ -456,41 +2309,138 @@ except Exception as e:
     exit(1)
 db_version = row[0].split('.')
 #print("Database version", db_version)
-
-
-# Is there anything that needs analysis?  Don't grab the lock unless there is.
-# Fetch sources where analysis != 1000 and retries < RETRIES
-rows = analysis_work()
-if len(rows) == 0:
-    # Nothing to do, so just quit
-    print("No source packages need analysis")
+# Issue
+if int(db_version[0]) > 9:
+    need_row = "ROW"
+else:
+    need_row = ""
+
+
+# Sources analyzed before the source_copyrights and source_licenses tables
+# existed have no summaries recorded there.  Fill them in, SUMMARY_SOURCES at
+# a time, if asked to.  (Sources with no copyrights or licenses at all are
+# done again each time.)  This doesn't need a worker slot.
+if args.summaries:
+    sql = "SELECT id FROM sources WHERE state = 9 AND \
+               (id NOT IN (SELECT source_id FROM source_copyrights) OR \
+                id NOT IN (SELECT source_id FROM source_licenses)) \
+           ORDER BY id;"
+    try:
+        cdb.execute(sql)
+        ids = [row[0] for row in cdb.fetchall()]
+    except Exception as e:
+        print("Failed to query the sources without recorded summaries")
+        print("Error: " + e.args[0])
+        ldb.close()
+        exit(1)
+    print(f"Recording the summaries of {len(ids)} source(s)")
+    for n in range(0, len(ids), SUMMARY_SOURCES):
+        record_copyrights(ids[n:n + SUMMARY_SOURCES])
+        record_licenses(ids[n:n + SUMMARY_SOURCES])
+        ldb.commit()
     ldb.close()
     exit(0)
-print(f"Got {len(rows)} package(s) that need(s) analysis")
 
 
-# Check for and obtain the analysis lock.  No sense running two copies of this
-# process right now.  Not that once grabbed, we need to ensure we don't exit
-# this program without releasing the lock.
-# FIXME: In the future, we may want parallel analysis tasks, and would need a
-# more robust way to handle queueing of these analyses.
+# Files matching the exclude_path table are left out of every analysis.  The
+# table is read again with each reprioritize(), so that a daemon sees changes.
+exclusions = load_exclusions()
+
+
+# Check for and obtain an analysis worker slot.  No sense running more than
+# ANALYSIS_WORKERS copies of this process.  Note that once grabbed, we need to
+# ensure we don't exit this program without releasing the lock.
 if not analysis.lock():
-    print("It appears another analysis task is running.  This one is exiting.")
+    print("It appears all analysis workers are running.  This one is exiting.")
+    ldb.close()
     exit(2)
 
 
+# Is there anything that needs analysis?  A daemon waits for some, so it
+# needs to be listening for notifications before it looks.
+if args.daemon:
+    cdb.execute("LISTEN oslcrs_analysis;")
+    ldb.commit()
+n = analysis_work()
+if n == 0 and not args.daemon:
+    # Nothing to do, so just quit
+    print("No source packages need analysis")
+    ldb.close()
+    exit(0)
+print(f"Got {n} package(s) that need(s) analysis; I am worker {worker}")
+
+
+# Set up this worker's work area on the scratch volume.  Anything already
+# there, and any sources still claimed by this worker, were left by an earlier
+# worker in this slot that has died.  The work area is removed again however
+# this program exits.
+scratch_cleanup()
+atexit.register(scratch_cleanup)
+os.makedirs(stagedir)                   # Prefetched archives wait here
+os.makedirs(batchdir)                   # Small sources are batched here
+os.makedirs(partdir, exist_ok=True)     # Downloads are resumed from here
+fetch_expire()
+release_claims()
+
+
+# Child processes (extractcode in particular) leave temporary subdirectories
+# behind.  Point them at a temporary subdirectory belonging to this worker, so
+# that they can be cleaned up without disturbing other workers.
+os.mkdir(worker_tmp)
+os.environ["TMPDIR"] = worker_tmp
+
+
+# Start the processes that hash files and unpack archives, before any of
+# our threads: forking a process while another of its threads holds a lock
+# (one inside OpenSSL, say, which hashlib uses too) can leave the child
+# deadlocked.  (As of Python 3.11, a "fork" pool forks all its processes
+# for its first task, so it's given one now.)  The "fork" context is used on
+# purpose; this script does all its work at the top level, so a start method
+# that re-imports it in the children would rerun the analysis.  There are
+# HASH_WORKERS processes, which is never fewer than SCAN_PROCESSES.
+context = multiprocessing.get_context("fork")
+worker_pool = ProcessPoolExecutor(max_workers=HASH_WORKERS, mp_context=context)
+worker_pool.submit(int).result()
+prefetcher = ThreadPoolExecutor(max_workers=max(PREFETCH, 1))
+estimator = ThreadPoolExecutor(max_workers=ESTIMATE_THREADS)
+estimates = []                          # (source id, future) of the sizes
+                                        # being estimated
+reprioritized = 0                       # Time of the last reprioritize()
+resources_fitted = 0                    # ...and of the last fit_resources()
+resource_model = (None,) * 5            # See fit_resources()
+
+
 ###
-# Main loop starts here.  Grab one package that needs analysis from the DB.
+# Main loop starts here.  Claim one package that needs analysis from the DB,
+# along with up to PREFETCH more to be downloaded while this one is analyzed.
 ###
-
-# FIXME: Python 3.8 brings in the := operator which would reduce the next few
-# lines.
+queue = []                              # Claimed sources, in analysis order
+batch = []                              # Small sources waiting to be scanned
+batch_started = 0                       # ...and when the first was set aside
+source_id = None
 while True:
-    rows = analysis_work()
-    if len(rows) < 1:
-        break                           # End of FIXME
+    if source_id != None:
+        release_claims(source_id)       # Done with the last package
+    reprioritize()
+    fit_resources()
+    queue += [[row, None] for row in claim_work(PREFETCH + 1 - len(queue))]
+    if len(batch) > 0 and (len(batch) >= BATCH_SOURCES or len(queue) < 1 or
+                           time.time() - batch_started >= BATCH_WAIT):
+        finish_batch(batch)             # Batch is full, has waited long
+                                        # enough, or nothing else to do
+        batch = []
+        source_id = None
+        continue
+    if len(queue) < 1:
+        if args.daemon:
+            source_id = None
+            wait_for_work()
+            continue
+        break
+    row, prefetch = queue.pop(0)
+    prefetch_queue(queue)               # Download the next ones meanwhile
 
-    w = analysis_decode(rows[0])        # Assign names to the values
+    w = analysis_decode(row)           # Assign names to the values
     source_id = w['id']                 # Keep these available for convenience
     source_name = w['name']
     source_type = w['type']
@@ -498,10 +2448,12 @@ while True:
     print(f"Starting package analysis on {source_name}")
 
 
-    # Create a temp subdirectory for this analysis run
-    pkgdir = tmpdir + str(w['id'])
-    if cmd(["/bin/mkdir", pkgdir],
-           "failed to create package analysis subdirectory"):
+    # Create a temp subdirectory for this analysis run, in our work area
+    pkgdir = scratchdir + '/' + str(w['id'])
+    try:
+        os.mkdir(pkgdir)
+    except OSError as e:
+        log_error("failed to create package analysis subdirectory", str(e))
         break                           # Don't retry on this sort of error
     os.chdir(pkgdir)
 
@@ -615,25 +2567,44 @@ while True:
     # print(f"Got fetch_url of {fetch_url}")
     if re.search('^file://', fetch_url):
         src_loc = re.sub('^file://', '', fetch_url)
-        if cmd(["cp", src_loc, '.'], "failed source file copy"):
-            clean_temp()
+    known = None
+    if prefetch == None:
+        known = fetch_cache_lookup(fetch_url)
+    if known != None:                   # Already analyzed, so don't fetch
+        fetched = {"error": "", "uuid": known}
+    elif prefetch == None:              # Not prefetched, so fetch it now
+        fetched = fetch_source(fetch_url, pkgdir)
+    else:                               # Wait for the prefetch to finish, then
+        fetched = prefetch.result()     # move the archive into place
+        staged = stagedir + '/' + str(source_id)
+        for name in os.listdir(staged):
+            os.rename(staged + '/' + name, pkgdir + '/' + name)
+        os.rmdir(staged)
+    if fetched["error"] != "":
+        log_error(fetched["error"], fetched["stderr"])
+        clean_temp()
+        if not fetched["retry"]:
             source_update(source_id, {"retries": RETRIES}) # No need to retry
-            continue
-    else:
-        if cmd(["/usr/bin/wget", "--no-check-certificate", fetch_url],
-               "failed source URL fetch"):
-            clean_temp()
-            continue                    # This could benefit from a retry
-    archive = [f for f in os.listdir('.') if os.path.isfile(f)][0]
-    # print(f"Successful download of {archive}")
+        if not fetched["retry"] or retries + 1 >= RETRIES:
+            fetch_discard(fetch_url)    # Won't be resumed
+        continue
+    if known == None:
+        fetch_cache_add(fetch_url, fetched)
+        for stage in fetched["stages"]:
+            record_stage(**stage)
+        archive = fetched["archive"]
+        # print(f"Successful download of {archive}")
 
 
     # Checksum the package?  Is it already analyzed?
     # FIXME: If we have a newer scancode, we may wish to re-analyze.
     # Capture new/different URL, even if we already analyzed this package.
-    pkg_name = os.listdir('.')[0]
+    if known == None:
+        pkg_name = os.listdir('.')[0]
+    else:
+        pkg_name = source_name          # Nothing was downloaded
     # print(f"Found package name of {pkg_name}")
-    pkg_uuid = swhid_of_file(archive)   # Compute SWH UUID for entire archive
+    pkg_uuid = fetched["uuid"]          # SWH UUID for entire archive
     # print(f"Computed package UUID of {pkg_uuid}")
     # FIXME: The "state = 9" will need to change when we do other pieces
     sql = f"SELECT id FROM sources \
@@ -684,14 +2655,38 @@ while True:
         continue                        # Nothing else to be done here
 
 
-    # Unpack the archive
-    source_update(source_id, {"status": "Unpacking source archive"})
-    if unpack_archive(pkgdir, pkg_name):
+    # Make sure there's room to unpack the archive, waiting for other workers
+    # to finish with their space if need be
+    need = scratch_needed(pkg_name)
+    if not scratch_reserve(need):
+        log_error("not enough scratch space to unpack source archive",
+                  f"expected to need {need} bytes in {SCRATCH}")
+        clean_temp()
+        continue
+
+
+    # Unpack the archive, unless we have the unpacked tree already
+    archive_size = os.path.getsize(pkg_name)
+    source_update(source_id, {"status": "Unpacking source archive",
+                              "est_size": archive_size})
+    started = stage_time()
+    cpu = children_cpu()
+    cached_tree = False
+    if EXTRACT_CACHE != "" and os.path.isdir(EXTRACT_CACHE + '/' + pkg_uuid):
+        os.rename(pkg_name, "archive")  # Keep it in case the copy fails
+        cached_tree = extract_cache_get(pkg_uuid, pkg_name)
+        if cached_tree:
+            os.remove("archive")
+        else:
+            os.rename("archive", pkg_name)
+    if not cached_tree and unpack_archive(pkgdir, pkg_name):
         # print("Failed extract")
         # exit(0)
         clean_temp()                    # Clean download subdirectory
         source_update(source_id, {"retries": RETRIES}) # No need to try again
         continue
+    record_stage("unpack", started, files=1, size=archive_size,
+                 cpu=children_cpu() - cpu)
     # print("Successful extract")
     # exit(0)
 
@@ -766,229 +2761,114 @@ while True:
     ###
 
 
-    source_update(source_id, {"status": "Pruning individual source files"})
-    # Generate file list
-    # FIXME: We ran into a problem where some test code included archives of
-    # about 1.2M empty files.  As a temporary workaround, we're going to avoid
-    # processing any file that is zero-length or one character long.  This is
-    # relatively safe since we can't imagine how copyrightable content could
-    # exist in files this short.
-    if cmd(["/bin/bash", "-c",
-            "cd *; /usr/bin/find -type f -size -2c -exec rm -f {} \;"],
-           "failed small file removal"):
-        clean_temp()                    # Clean download subdirectory
-        continue
-    # END FIXME for large number of empty or small files
-    if cmd(["/bin/bash", "-c",
-            "cd *; /usr/bin/find -type f | /bin/sed 's/^\.\///' >../filelist"],
-           "failed file list"):
-        clean_temp()                    # Clean download subdirectory
-        continue
-    # print("Successfully listed all files")
-
-
     # Iterate over files:
+    # - prune tiny files (see walk_tree())
+    # - skip files matching the exclude_path table
     # - compute per-file UUID
     # - prune if we already analyzed this file
     # Keep list of file paths, files, and UUIDs
+    source_update(source_id, {"status": "Pruning individual source files"})
     uuids = dict()                      # SWH UUIDs indexed by path
+    sizes = dict()                      # File sizes indexed by path
     file_adds = dict()                  # List of all SWH UUIDs we need to add
                                         # to the DB, indexed by UUID
-    with open("paths", 'w') as ofp:
-        # ofp.write('Hello\n')
-        with open("filelist") as ifp:
-            line = ifp.readline()[:-1]  # Eliminate only trailing newline
-            while line:
-                thisfile = pkg_name + '/' + line
-                file_uuid = swhid_of_file(thisfile) # Compute file SWH UUID
-                ofp.write(file_uuid + ' ' + line + '\n')
-                uuids[line] = file_uuid # Keep all of these paths
-                file_id = isfile_done(file_uuid)
-                if file_id == None:
-                    file_adds[file_uuid] = None # We'll get file ID later
-                else:
-                    # print(f"file {thisfile} was already done")
-                    os.remove(thisfile) # Prune the file to save analysis time
-                line = ifp.readline()[:-1]
+    excluded = []                       # Excluded paths, with file counts
+    started = stage_time()
+    cpu = children_cpu()
+    try:
+        with open("paths", 'w') as ofp:
+            for path, file_uuid, size in tree_swhids(pkg_name, exclusions,
+                                                     excluded):
+                ofp.write(file_uuid + ' ' + path + '\n')
+                uuids[path] = file_uuid # Keep all of these paths
+                sizes[path] = size
+    except OSError as e:
+        log_error("failed file list", str(e))
+        clean_temp()                    # Clean download subdirectory
+        continue
+    # print("Successfully listed all files")
+    record_stage("hash", started, files=len(uuids), size=sum(sizes.values()),
+                 cpu=children_cpu() - cpu)
+    if not cached_tree:
+        extract_cache_put(pkg_uuid, pkg_name)
+    started = stage_time()
+    for path, count in excluded:        # The cached tree keeps these, in case
+        path = pkg_name + '/' + path    # the exclusions change
+        if os.path.isdir(path):
+            shutil.rmtree(path)
+        else:
+            os.remove(path)
+    excluded = sum([count for path, count in excluded])
+    if excluded > 0:
+        print(f"Excluded {excluded} files matching exclude_path")
+    file_ids = files_done(uuids.values()) # Files we already have, by UUID
+    scan_files = []                     # Files left to scan, with sizes
+    for line, file_uuid in uuids.items():
+        if file_uuid in file_ids:
+            # print(f"file {line} was already done")
+            os.remove(pkg_name + '/' + line) # Prune the file to save analysis
+                                        # time
+        else:
+            file_adds[file_uuid] = None # We'll get file ID later
+            scan_files.append((line, sizes[line]))
+    pruned = [size for line, size in sizes.items() if uuids[line] in file_ids]
+    record_stage("prune", started, files=excluded + len(pruned),
+                 size=sum(pruned))
+
+
+    # Everything needed to finish this source, once it has been scanned
+    pend = {"id": source_id, "retries": retries, "uuids": uuids,
+            "file_ids": file_ids, "scan_files": scan_files,
+            "binaries": binaries, "src_pkg_name": src_pkg_name,
+            "pkg_sum_license": pkg_sum_license, "upstream_url": upstream_url,
+            "pkg_uuid": pkg_uuid, "src_loc": src_loc, "excluded": excluded}
+
+
+    # Small packages are set aside, to be scanned in a batch with others (see
+    # finish_batch()).  This worker keeps its claim on the source meanwhile.
+    # A source that has failed before is always analyzed on its own, as is a
+    # priority one (a single upload, say), which shouldn't wait for others.
+    if BATCH_SOURCES > 1 and retries == 0 and w['priority'] <= 0 and \
+       len(scan_files) <= BATCH_FILES and \
+       sum([size for path, size in scan_files]) <= BATCH_BYTES:
+        source_update(source_id,
+                      {"status": "Waiting for batched scancode analysis"})
+        os.rename(pkg_name, batchdir + '/' + str(source_id))
+        if len(batch) == 0:
+            batch_started = time.time()
+        batch.append(pend)
+        clean_temp()                    # Clean download subdirectory
+        source_id = None                # Don't release the claim yet
+        continue
 
 
-    # Submit remaining tree to scancode for license and copyright analysis
+    # Submit remaining tree to scancode for license and copyright analysis,
+    # recording per-file license and copyright results in DB as they arrive.
+    # FIXME: When results from an updated version of scancode are to replace
+    # existing entries, the SQL will be a lot more complicated!  Right now,
+    # duplicates are being ignored, which leads to out-of-date information.
+    #
+    # Everything from here to the source_update() in finish_source() is
+    # recorded in a single transaction, so there are no status updates in
+    # between.  Any wait for memory comes first.
+    processes = memory_reserve(len(scan_files),
+                               sum([size for path, size in scan_files]),
+                               [source_id])
     source_update(source_id, {"status": "Scancode license/copyright analysis"})
     os.chdir(pkg_name)
-    if cmd([scancode, "-plc", "--quiet", "--json", "../scancode.json",
-            "--only-findings", "--strip-root", "--processes", "16",
-            "--timeout", "0", "--max-depth", "0", '.'],
-           "failed scancode license/copyright analysis"):
+    stages = []
+    err = scan_and_record(uuids, file_adds, scan_files, stages, processes)
+    scratch_release("memory")
+    if err != "":
+        log_error("failed scancode license/copyright analysis", err)
         clean_temp()                    # Clean download subdirectory
         source_update(source_id, {"retries": RETRIES}) # No need to try again
         continue
     # print("Successful scancode license/copyright analysis")
+    for stage in stages:
+        record_stage(**stage)
     os.chdir('..')
-
-
-    # Each new result will require a "files" table entry.  Add these first.
-    source_update(source_id, {"status": "Adding new files to database"})
-    for swh_uuid in file_adds.keys():
-        file_adds[swh_uuid] = addfile(swh_uuid)
-
-
-    # Record per-file license and copyright results in DB
-    # FIXME: When results from an updated version of scancode are to replace
-    # existing entries, the SQL will be a lot more complicated!  Right now,
-    # duplicates are being ignored, which leads to out-of-date information.
-    source_update(source_id, {"status": "Recording license/copyright info"})
-    with open("scancode.json") as scfp:
-        sc = json.load(scfp)            # Read scan results into memory
-                                        # FIXME: Might this be too big a
-                                        # structure to fit?
-    scancode_version = sc["headers"][0]["tool_version"]
-    d = scancode_version.split('.')     # Compute an integer version related
-                                        # to the scancode version
-    detector = 0
-    for i in d:
-        detector = detector * 1000 + int(i)
-    # print(f"Detector: {detector}")
-    for scf in sc["files"]:
-        if scf["type"] == "file":
-            # print(f"Results for file {scf['path']}")
-            # print(f"SWH UUID: {uuids[scf['path']]}")
-            fid = file_adds[uuids[scf['path']]]
-            # print(f"DB id was {fid}")
-            for lic in scf["licenses"]:
-                # print(f"License {lic['key']}, score {lic['score']}, " +
-                #       f"rule {lic['matched_rule']['identifier']}, " +
-                #       f"start {lic['start_line']} end {lic['end_line']}")
-
-                ###
-                # FIXME WARNING
-                #
-                # Early in its use of scancode, the PELC team found that
-                # certain license detections were seen, but these detections
-                # are not useful.  Although scancode is detecting "something",
-                # it's not an actionable result.  We decided that these would
-                # be ignored.  Due to this, these detections were dropped
-                # before they became part of the result database, as well
-                # as not being present in the licenses table.  This is not a
-                # good long-term strategy.  It would be better to record the
-                # detection, but then filter it out upon presentation to the
-                # user.  However, this will take more work on the reporting
-                # side.
-                #
-                # For now, I am following the PELC example of skipping the
-                # recording of these license detections.  However, we will
-                # need to change how we handle these in the future, as well
-                # as rescan *all* the packages/files that we have in the DB,
-                # in order to update the detection results.
-                ###
-                if lic['key'] == 'unknown-license-reference':
-                    continue            # Skip adding this license detection
-                addrow("license_detects",
-                       {
-                         "file_id": fid,
-                         "lic_name": lic['key'],
-                         "score": lic['score'],
-                         "rule": lic['matched_rule']['identifier'],
-                         "start_line": lic['start_line'],
-                         "end_line": lic['end_line'],
-                         "detector": detector
-                       })
-            for copy in scf["copyrights"]:
-                # print(f"Copyright: {copy['value']}")
-                addrow("copyrights",
-                       {
-                         "file_id": fid,
-                         "copyright": copy['value'],
-                         "start_line": copy['start_line'],
-                         "end_line": copy['end_line'],
-                         "detector": detector
-                       })
-        else:
-            # print(f"Would ignore {scf['path']}, type {scf['type']}")
-            pass                        # Python NOOP
-
-
-    # Record all file paths in the "paths" table
-    source_update(source_id, {"status": "Recording file paths"})
-    for key, value in uuids.items():
-        # params = {
-        #            "source_id": source_id,
-        #            "file_id": isfile_done(value),
-        #            "path": key
-        #          }
-        addrow("paths",
-               {
-                 "source_id": source_id,
-                 "file_id": isfile_done(value),
-                 "path": key
-               })
-
-
-    # We need to record the upstream URL in the sources table.  The value comes
-    # from earlier, when we gathered metadata from the source archive or else
-    # it was provided to us.
-    source_update(source_id, {"url": upstream_url})
-
-
-    # Now that source analysis is done, we need to add the binary packages
-    # FIXME: Error checks?  Duplicates?  The current code will simply replace
-    # existing nvr values with new ones.  This is *not* desired.  We *hope* to
-    # not have duplicate nvr values, as these will make it difficult/impossible
-    # to refer to packages by nvr, but if/when there is a duplicate, we need
-    # to detect it and decide what to do about it.
-    for binary in binaries:
-        addrow("packages",
-               {
-                 "nvr": binary['nvr'],
-                 "source_id": source_id,
-                 "sum_license": binary['license']
-               })
-    # One last special case, and this is probably a future FIXME!
-    # We have imported source packages, yet this system is designed to produce
-    # reports indexed by binary packages.  (After all, that's what we ship,
-    # right?)  Yet, depending on the way the manifest data is handed to us and
-    # the customer desires, we may want to index these license reports based on
-    # source packages.  We could have a lot of duplicate reporting code (and we
-    # might want to do this in the future for full flexibility), but since this
-    # is a prototype, I'm trying a short-cut, to see how well it works.
-    #
-    # We've already added the specified binary packages.  We will ALSO add
-    # another binary package and set a flag so we know it's not a real binary
-    # package, but one corresponding to the source package name.  Doing this
-    # means that the reporting code can simply search on package names and not
-    # have to handle special cases.  Yet, these extra entries are flagged in
-    # case we want to eliminate them later.  Here's the code that adds these
-    # fake binary packages.
-    addrow("packages",
-           {
-             "nvr": src_pkg_name,
-             "source_id": source_id,
-             "sum_license": pkg_sum_license,
-             "source": 1
-           })
-    # END fake binary package FIXME
-    source_update(source_id, {"status": "scancode analysis complete"})
-
-
-    # Record package checksum and mark scancode as being "done"
-    # Do not clear "error", because unpack errors may need to be reviewed
-    source_update(source_id, {"checksum": pkg_uuid, "state": "9"})
-
-
-    # If we were analyzing a local file, now is the time to remove that file
-    # so we don't run out of server space.  Recall that we saved src_loc
-    # earlier for this purpose.
-    if src_loc != "":
-        if cmd(["rm", src_loc],
-               f"failed to remove already-analyzed file {src_loc}"):
-            clean_temp()
-            continue
-        # Try to remove the subdirectory this file was in, in case it's now
-        # empty.
-        cmdstr = f'rmdir --ignore-fail-on-non-empty "`dirname {src_loc}`"'
-        if cmd(["/bin/bash", "-c", cmdstr],
-               f"failed to remove subdir of already-analyzed file {src_loc}"):
-            clean_temp()
-            continue
+    finish_source(pend, file_adds)
 
 
     ###
@@ -1011,7 +2891,16 @@ while True:
 
 
 # Clean up and exit script
+# - Stop any prefetches, and remove what they fetched
+# - Give up any source still claimed, after an error above
 # - Release any lock file
+for row, prefetch in queue:
+    if prefetch != None:
+        prefetch.cancel()
+prefetcher.shutdown()
+estimator.shutdown()
+worker_pool.shutdown()
+release_claims()                        # The work area goes at exit
 ldb.close()
 print("End of analysis script")
 exit(0)
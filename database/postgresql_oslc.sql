@@ -43,8 +43,116 @@ SET row_security = off;
 COMMENT ON DATABASE "OSLC" IS 'Open Source License Compliance Reporting Database';
 
 
+--
+-- Name: notify_analysis(); Type: FUNCTION; Schema: public; Owner: -
+--
+
+CREATE FUNCTION public.notify_analysis() RETURNS trigger
+    LANGUAGE plpgsql
+    AS $$
+BEGIN
+    PERFORM pg_notify('oslcrs_analysis', '');
+    RETURN NULL;
+END;
+$$;
+
+
+--
+-- Name: FUNCTION notify_analysis(); Type: COMMENT; Schema: public; Owner: -
+--
+
+COMMENT ON FUNCTION public.notify_analysis() IS 'wakes the analysis daemons when sources are queued';
+
+
 SET default_tablespace = '';
 
+--
+-- Name: analysis_stages; Type: TABLE; Schema: public; Owner: -
+--
+
+CREATE TABLE public.analysis_stages (
+    source_id bigint NOT NULL,
+    stage character varying(16) NOT NULL,
+    worker character varying(256),
+    started timestamp with time zone NOT NULL,
+    ended timestamp with time zone NOT NULL,
+    files integer,
+    bytes bigint,
+    cpu_seconds double precision,
+    max_rss bigint
+);
+
+
+--
+-- Name: TABLE analysis_stages; Type: COMMENT; Schema: public; Owner: -
+--
+
+COMMENT ON TABLE public.analysis_stages IS 'time taken by each stage of each source analysis; scan and ingest overlap';
+
+
+--
+-- Name: COLUMN analysis_stages.source_id; Type: COMMENT; Schema: public; Owner: -
+--
+
+COMMENT ON COLUMN public.analysis_stages.source_id IS 'analyzed source';
+
+
+--
+-- Name: COLUMN analysis_stages.stage; Type: COMMENT; Schema: public; Owner: -
+--
+
+COMMENT ON COLUMN public.analysis_stages.stage IS 'download, swhid, unpack, hash, prune, scan, ingest or paths';
+
+
+--
+-- Name: COLUMN analysis_stages.worker; Type: COMMENT; Schema: public; Owner: -
+--
+
+COMMENT ON COLUMN public.analysis_stages.worker IS 'analysis worker that ran the stage';
+
+
+--
+-- Name: COLUMN analysis_stages.started; Type: COMMENT; Schema: public; Owner: -
+--
+
+COMMENT ON COLUMN public.analysis_stages.started IS 'when the stage started';
+
+
+--
+-- Name: COLUMN analysis_stages.ended; Type: COMMENT; Schema: public; Owner: -
+--
+
+COMMENT ON COLUMN public.analysis_stages.ended IS 'when the stage ended';
+
+
+--
+-- Name: COLUMN analysis_stages.files; Type: COMMENT; Schema: public; Owner: -
+--
+
+COMMENT ON COLUMN public.analysis_stages.files IS 'number of files the stage dealt with, if known';
+
+
+--
+-- Name: COLUMN analysis_stages.bytes; Type: COMMENT; Schema: public; Owner: -
+--
+
+COMMENT ON COLUMN public.analysis_stages.bytes IS 'number of bytes the stage dealt with, if known';
+
+
+--
+-- Name: COLUMN analysis_stages.cpu_seconds; Type: COMMENT; Schema: public; Owner: -
+--
+
+COMMENT ON COLUMN public.analysis_stages.cpu_seconds IS 'CPU seconds used by the processes the stage ran, if known';
+
+
+--
+-- Name: COLUMN analysis_stages.max_rss; Type: COMMENT; Schema: public; Owner: -
+--
+
+COMMENT ON COLUMN public.analysis_stages.max_rss IS 'peak memory in bytes of the largest process the stage ran, if known';
+
+
 --
 -- Name: container_packages; Type: TABLE; Schema: public; Owner: -
 --
@@ -274,6 +382,69 @@ CREATE SEQUENCE public.exclude_path_id_seq
 ALTER SEQUENCE public.exclude_path_id_seq OWNED BY public.exclude_path.id;
 
 
+--
+-- Name: fetch_cache; Type: TABLE; Schema: public; Owner: -
+--
+
+CREATE TABLE public.fetch_cache (
+    fetch_url text NOT NULL,
+    checksum character(50) NOT NULL,
+    etag text,
+    last_modified text,
+    content_length bigint,
+    fetched timestamp with time zone DEFAULT now() NOT NULL
+);
+
+
+--
+-- Name: TABLE fetch_cache; Type: COMMENT; Schema: public; Owner: -
+--
+
+COMMENT ON TABLE public.fetch_cache IS 'checksums of source archives already fetched, by URL';
+
+
+--
+-- Name: COLUMN fetch_cache.fetch_url; Type: COMMENT; Schema: public; Owner: -
+--
+
+COMMENT ON COLUMN public.fetch_cache.fetch_url IS 'URL the source archive was fetched from';
+
+
+--
+-- Name: COLUMN fetch_cache.checksum; Type: COMMENT; Schema: public; Owner: -
+--
+
+COMMENT ON COLUMN public.fetch_cache.checksum IS 'SWH UUID of the fetched archive';
+
+
+--
+-- Name: COLUMN fetch_cache.etag; Type: COMMENT; Schema: public; Owner: -
+--
+
+COMMENT ON COLUMN public.fetch_cache.etag IS 'ETag header from the fetch, if any';
+
+
+--
+-- Name: COLUMN fetch_cache.last_modified; Type: COMMENT; Schema: public; Owner: -
+--
+
+COMMENT ON COLUMN public.fetch_cache.last_modified IS 'Last-Modified header from the fetch, if any';
+
+
+--
+-- Name: COLUMN fetch_cache.content_length; Type: COMMENT; Schema: public; Owner: -
+--
+
+COMMENT ON COLUMN public.fetch_cache.content_length IS 'Content-Length header from the fetch, if any';
+
+
+--
+-- Name: COLUMN fetch_cache.fetched; Type: COMMENT; Schema: public; Owner: -
+--
+
+COMMENT ON COLUMN public.fetch_cache.fetched IS 'when the archive was last fetched';
+
+
 --
 -- Name: files; Type: TABLE; Schema: public; Owner: -
 --
@@ -691,7 +862,13 @@ CREATE TABLE public.sources (
     error text DEFAULT ''::text NOT NULL,
     type character varying(8) NOT NULL,
     retries integer DEFAULT 0,
-    status text DEFAULT ''::text NOT NULL
+    status text DEFAULT ''::text NOT NULL,
+    claimed timestamp with time zone,
+    worker character varying(256),
+    priority smallint DEFAULT 0 NOT NULL,
+    blocking integer,
+    est_size bigint,
+    excluded integer
 );
 
 
@@ -786,19 +963,135 @@ COMMENT ON COLUMN public.sources.retries IS 'number of analysis failures';
 COMMENT ON COLUMN public.sources.status IS 'As analysis proceeds, gets filled in with the status of the analysis';
 
 
+--
+-- Name: COLUMN sources.claimed; Type: COMMENT; Schema: public; Owner: -
+--
+
+COMMENT ON COLUMN public.sources.claimed IS 'when an analysis worker claimed this source';
+
+
+--
+-- Name: COLUMN sources.worker; Type: COMMENT; Schema: public; Owner: -
+--
+
+COMMENT ON COLUMN public.sources.worker IS 'analysis worker that claimed this source';
+
+
+--
+-- Name: COLUMN sources.priority; Type: COMMENT; Schema: public; Owner: -
+--
+
+COMMENT ON COLUMN public.sources.priority IS 'analysis priority; higher is analyzed first (1 for single uploads, 0 for bulk)';
+
+
+--
+-- Name: COLUMN sources.blocking; Type: COMMENT; Schema: public; Owner: -
+--
+
+COMMENT ON COLUMN public.sources.blocking IS 'fewest packages missing from any release needing this source, or null';
+
+
+--
+-- Name: COLUMN sources.est_size; Type: COMMENT; Schema: public; Owner: -
+--
+
+COMMENT ON COLUMN public.sources.est_size IS 'expected archive size in bytes; -1 if it could not be found';
+
+
+--
+-- Name: COLUMN sources.excluded; Type: COMMENT; Schema: public; Owner: -
+--
+
+COMMENT ON COLUMN public.sources.excluded IS 'number of files left out of the analysis, as they matched exclude_path';
+
+
+--
+-- Name: source_copyrights; Type: TABLE; Schema: public; Owner: -
+--
+
+CREATE TABLE public.source_copyrights (
+    source_id bigint NOT NULL,
+    copyright text NOT NULL
+);
+
+
+--
+-- Name: TABLE source_copyrights; Type: COMMENT; Schema: public; Owner: -
+--
+
+COMMENT ON TABLE public.source_copyrights IS 'distinct copyright statements found in each analyzed source, recorded by analyze.py as the source is ingested';
+
+
+--
+-- Name: COLUMN source_copyrights.source_id; Type: COMMENT; Schema: public; Owner: -
+--
+
+COMMENT ON COLUMN public.source_copyrights.source_id IS 'analyzed source';
+
+
+--
+-- Name: COLUMN source_copyrights.copyright; Type: COMMENT; Schema: public; Owner: -
+--
+
+COMMENT ON COLUMN public.source_copyrights.copyright IS 'its distinct copyright statements, sorted, one per line';
+
+
+--
+-- Name: source_licenses; Type: TABLE; Schema: public; Owner: -
+--
+
+CREATE TABLE public.source_licenses (
+    source_id bigint NOT NULL,
+    lic_name character varying(128) NOT NULL,
+    detections integer NOT NULL,
+    max_score real
+);
+
+
+--
+-- Name: TABLE source_licenses; Type: COMMENT; Schema: public; Owner: -
+--
+
+COMMENT ON TABLE public.source_licenses IS 'licenses detected in each analyzed source, recorded by analyze.py as the source is ingested';
+
+
+--
+-- Name: COLUMN source_licenses.source_id; Type: COMMENT; Schema: public; Owner: -
+--
+
+COMMENT ON COLUMN public.source_licenses.source_id IS 'analyzed source';
+
+
+--
+-- Name: COLUMN source_licenses.lic_name; Type: COMMENT; Schema: public; Owner: -
+--
+
+COMMENT ON COLUMN public.source_licenses.lic_name IS 'scancode license key, as in license_detects';
+
+
+--
+-- Name: COLUMN source_licenses.detections; Type: COMMENT; Schema: public; Owner: -
+--
+
+COMMENT ON COLUMN public.source_licenses.detections IS 'number of detections of the license in the files of the source, a file counting once for each of its paths';
+
+
+--
+-- Name: COLUMN source_licenses.max_score; Type: COMMENT; Schema: public; Owner: -
+--
+
+COMMENT ON COLUMN public.source_licenses.max_score IS 'best score of any of those detections';
+
+
 --
 -- Name: package_copyrights; Type: VIEW; Schema: public; Owner: -
 --
 
 CREATE VIEW public.package_copyrights AS
  SELECT packages.id AS package_id,
-    string_agg(DISTINCT copyrights.copyright, '
-'::text ORDER BY copyrights.copyright) AS copyright
-   FROM (((public.packages
-     JOIN public.sources ON ((packages.source_id = sources.id)))
-     JOIN public.paths ON ((paths.source_id = sources.id)))
-     JOIN public.copyrights ON ((copyrights.file_id = paths.file_id)))
-  GROUP BY packages.id;
+    source_copyrights.copyright
+   FROM (public.packages
+     JOIN public.source_copyrights ON ((source_copyrights.source_id = packages.source_id)));
 
 
 --
@@ -945,30 +1238,28 @@ COMMENT ON COLUMN public.releases.notes IS 'comments, such as the source of this
 
 
 --
--- Name: packages_per_release; Type: VIEW; Schema: public; Owner: -
+-- Name: packages_per_release; Type: TABLE; Schema: public; Owner: -
 --
 
-CREATE VIEW public.packages_per_release AS
- SELECT releases.id AS release_id,
-    release_packages.package_nvr,
-    release_packages.source
-   FROM (public.releases
-     JOIN public.release_packages ON ((release_packages.release_id = releases.id)))
-UNION
- SELECT releases.id AS release_id,
-    container_packages.package_nvr,
-    container_packages.source
-   FROM (((public.releases
-     JOIN public.release_containers ON ((release_containers.release_id = releases.id)))
-     JOIN public.containers ON ((containers.id = release_containers.container_id)))
-     JOIN public.container_packages ON ((container_packages.container_id = containers.id)));
+CREATE TABLE public.packages_per_release (
+    release_id integer NOT NULL,
+    package_nvr character varying(512) NOT NULL,
+    source smallint DEFAULT 0 NOT NULL
+);
 
 
 --
--- Name: VIEW packages_per_release; Type: COMMENT; Schema: public; Owner: -
+-- Name: TABLE packages_per_release; Type: COMMENT; Schema: public; Owner: -
 --
 
-COMMENT ON VIEW public.packages_per_release IS 'generates a list of packages (nvr) for any release';
+COMMENT ON TABLE public.packages_per_release IS 'list of packages (nvr) for any release, from release_packages and the container_packages of its release_containers; kept up to date by oslcrs.py as manifests are imported';
+
+
+--
+-- Name: COLUMN packages_per_release.source; Type: COMMENT; Schema: public; Owner: -
+--
+
+COMMENT ON COLUMN public.packages_per_release.source IS '1 for a source package, 0 for a binary one, as in release_packages';
 
 
 --
@@ -1188,6 +1479,14 @@ ALTER TABLE ONLY public.exclude_path
     ADD CONSTRAINT exclude_path_pkey PRIMARY KEY (id);
 
 
+--
+-- Name: fetch_cache fetch_cache_pkey; Type: CONSTRAINT; Schema: public; Owner: -
+--
+
+ALTER TABLE ONLY public.fetch_cache
+    ADD CONSTRAINT fetch_cache_pkey PRIMARY KEY (fetch_url);
+
+
 --
 -- Name: files files_pkey1; Type: CONSTRAINT; Schema: public; Owner: -
 --
@@ -1236,6 +1535,14 @@ ALTER TABLE ONLY public.packages
     ADD CONSTRAINT packages_nvr_source_key UNIQUE (nvr, source);
 
 
+--
+-- Name: packages_per_release packages_per_release_pkey; Type: CONSTRAINT; Schema: public; Owner: -
+--
+
+ALTER TABLE ONLY public.packages_per_release
+    ADD CONSTRAINT packages_per_release_pkey PRIMARY KEY (release_id, package_nvr, source);
+
+
 --
 -- Name: packages packages_pkey; Type: CONSTRAINT; Schema: public; Owner: -
 --
@@ -1308,11 +1615,55 @@ ALTER TABLE ONLY public.sources
     ADD CONSTRAINT sources_swh_key UNIQUE (swh);
 
 
+--
+-- Name: source_copyrights source_copyrights_pkey; Type: CONSTRAINT; Schema: public; Owner: -
+--
+
+ALTER TABLE ONLY public.source_copyrights
+    ADD CONSTRAINT source_copyrights_pkey PRIMARY KEY (source_id);
+
+
+--
+-- Name: source_licenses source_licenses_pkey; Type: CONSTRAINT; Schema: public; Owner: -
+--
+
+ALTER TABLE ONLY public.source_licenses
+    ADD CONSTRAINT source_licenses_pkey PRIMARY KEY (source_id, lic_name);
+
+
+--
+-- Name: analysis_stages_source_index; Type: INDEX; Schema: public; Owner: -
+--
+
+CREATE INDEX analysis_stages_source_index ON public.analysis_stages USING btree (source_id);
+
+
+--
+-- Name: analysis_stages_started_index; Type: INDEX; Schema: public; Owner: -
+--
+
+CREATE INDEX analysis_stages_started_index ON public.analysis_stages USING btree (started);
+
+
 --
 -- Name: file_swh_index; Type: INDEX; Schema: public; Owner: -
 --
 
-CREATE INDEX file_swh_index ON public.files USING hash (swh);
+CREATE UNIQUE INDEX file_swh_index ON public.files USING btree (swh);
+
+
+--
+-- Name: sources_checksum_index; Type: INDEX; Schema: public; Owner: -
+--
+
+CREATE INDEX sources_checksum_index ON public.sources USING btree (checksum);
+
+
+--
+-- Name: sources_queue_index; Type: INDEX; Schema: public; Owner: -
+--
+
+CREATE INDEX sources_queue_index ON public.sources USING btree (priority DESC, blocking, NULLIF(est_size, '-1'::bigint), id) WHERE (state <> 9);
 
 
 --
@@ -1322,6 +1673,13 @@ CREATE INDEX file_swh_index ON public.files USING hash (swh);
 CREATE UNIQUE INDEX packages_package_id ON public.overrides USING btree (package_id);
 
 
+--
+-- Name: sources sources_notify_analysis; Type: TRIGGER; Schema: public; Owner: -
+--
+
+CREATE TRIGGER sources_notify_analysis AFTER INSERT ON public.sources FOR EACH STATEMENT EXECUTE PROCEDURE public.notify_analysis();
+
+
 --
 -- Name: container_packages container_packages_container_id_fkey; Type: FK CONSTRAINT; Schema: public; Owner: -
 --
@@ -1362,6 +1720,14 @@ ALTER TABLE ONLY public.packages
     ADD CONSTRAINT packages_source_id_fkey FOREIGN KEY (source_id) REFERENCES public.sources(id) ON DELETE CASCADE;
 
 
+--
+-- Name: packages_per_release packages_per_release_release_id_fkey; Type: FK CONSTRAINT; Schema: public; Owner: -
+--
+
+ALTER TABLE ONLY public.packages_per_release
+    ADD CONSTRAINT packages_per_release_release_id_fkey FOREIGN KEY (release_id) REFERENCES public.releases(id) ON DELETE CASCADE;
+
+
 --
 -- Name: paths paths_file_id_fkey; Type: FK CONSTRAINT; Schema: public; Owner: -
 --
@@ -1410,6 +1776,22 @@ ALTER TABLE ONLY public.releases
     ADD CONSTRAINT releases_product_id_fkey FOREIGN KEY (product_id) REFERENCES public.products(id) ON DELETE CASCADE;
 
 
+--
+-- Name: source_copyrights source_copyrights_source_id_fkey; Type: FK CONSTRAINT; Schema: public; Owner: -
+--
+
+ALTER TABLE ONLY public.source_copyrights
+    ADD CONSTRAINT source_copyrights_source_id_fkey FOREIGN KEY (source_id) REFERENCES public.sources(id) ON DELETE CASCADE;
+
+
+--
+-- Name: source_licenses source_licenses_source_id_fkey; Type: FK CONSTRAINT; Schema: public; Owner: -
+--
+
+ALTER TABLE ONLY public.source_licenses
+    ADD CONSTRAINT source_licenses_source_id_fkey FOREIGN KEY (source_id) REFERENCES public.sources(id) ON DELETE CASCADE;
+
+
 --
 -- Name: DATABASE "OSLC"; Type: ACL; Schema: -; Owner: -
 --
@@ -1417,6 +1799,13 @@ ALTER TABLE ONLY public.releases
 GRANT ALL ON DATABASE "OSLC" TO oslc;
 
 
+--
+-- Name: TABLE analysis_stages; Type: ACL; Schema: public; Owner: -
+--
+
+GRANT ALL ON TABLE public.analysis_stages TO oslc;
+
+
 --
 -- Name: TABLE container_packages; Type: ACL; Schema: public; Owner: -
 --
@@ -1466,6 +1855,13 @@ GRANT ALL ON SEQUENCE public.exclude_path_comment_seq TO oslc;
 GRANT ALL ON SEQUENCE public.exclude_path_id_seq TO oslc;
 
 
+--
+-- Name: TABLE fetch_cache; Type: ACL; Schema: public; Owner: -
+--
+
+GRANT ALL ON TABLE public.fetch_cache TO oslc;
+
+
 --
 -- Name: TABLE files; Type: ACL; Schema: public; Owner: -
 --
@@ -1529,6 +1925,20 @@ GRANT ALL ON TABLE public.paths TO oslc;
 GRANT ALL ON TABLE public.sources TO oslc;
 
 
+--
+-- Name: TABLE source_copyrights; Type: ACL; Schema: public; Owner: -
+--
+
+GRANT ALL ON TABLE public.source_copyrights TO oslc;
+
+
+--
+-- Name: TABLE source_licenses; Type: ACL; Schema: public; Owner: -
+--
+
+GRANT ALL ON TABLE public.source_licenses TO oslc;
+
+
 --
 -- Name: TABLE package_copyrights; Type: ACL; Schema: public; Owner: -
 --
@@ -7,10 +7,12 @@
 import json                             # May not be needed
 import os                               # Environment variable support
 import subprocess                       # Used to analyze packages
+import threading                        # Limits use of the connection pool
 import psycopg2                         # Postgress connector library
+import psycopg2.pool                    # Connections shared between requests
 import requests                         # Used to obtain Corgi data
 from urllib.parse import urlencode, quote_plus
-from flask import Flask, render_template, request, jsonify, Response
+from flask import Flask, render_template, request, jsonify, Response, g
 app = Flask(__name__)
 app.config['UPLOAD_FOLDER'] = "/tmp"    # Flask application configuration
 app.config['MAX_CONTENT_PATH'] = 256 * 1024 * 1024 # 256 MB maximum upload
@@ -21,8 +23,6 @@ app.config['MAX_CONTENT_PATH'] = 256 * 1024 * 1024 # 256 MB maximum upload
 legend = ["Proposed", "Approved", "Rejected", "New", "Ignored", "Provisional"]
 # Note that all paths are relative to the subdirectory from which oslcrs is run
 upload_dir = "/tmp/oslcrs/"             # Directory used to store source files
-analysis_program = "./analyze.py"       # This is the script that performs all
-                                        # license analysis
 
 
 # These are the set of files that we consider to be potential summary license
@@ -34,23 +34,48 @@ summary_license_file_patterns = [
 ]
 summary_license_threshold = 30          # Percent matching threshold for valid
                                         # license matches
+STAGE_HOURS = 24                        # Analysis stage times are shown for
+                                        # this many recent hours
 RETRIES = 3                             # Number of analysis retries before
                                         # we consider this a failed run
                                         # WARNING: Ensure the value in
                                         # analyze.py is consistent with this
+PRIORITY_INTERACTIVE = 1                # Analysis priority of a single source
+PRIORITY_BULK = 0                       # uploaded, and of one of many
                                         # value
 
 
 # Functions needed by this program
+# Requests are served by several threads at once, so each request checks a
+# connection out of a pool shared by all of them, and keeps it (and its
+# cursor) in flask.g until the request is done.  At most DBpool connections
+# are open; a request finding them all in use waits for one to be returned.
 class ldb():                            # License database class
+    pool = None                         # Created by the first open()
+    pool_lock = threading.Lock()        # Protects the creation of the pool
+    slots = None                        # Connections not checked out
+
     # Open report database, returning a connection cursor
     def open(db, host, port, user, passwd):
+        if "ldb_cdb" in g:
+            return(g.ldb_cdb)           # Already open for this request
         try:
-            ldb.conn = psycopg2.connect(f"dbname='{db}' port='{port}' " + \
-                                        f"host='{host}' user='{user}' " + \
-                                        f"password='{passwd}'")
-            ldb.cdb = ldb.conn.cursor()
-            return(ldb.cdb)
+            with ldb.pool_lock:
+                if ldb.pool == None:
+                    ldb.pool = psycopg2.pool.ThreadedConnectionPool(
+                        1, DBpool, f"dbname='{db}' port='{port}' " + \
+                                   f"host='{host}' user='{user}' " + \
+                                   f"password='{passwd}'")
+                    ldb.slots = threading.BoundedSemaphore(DBpool)
+            ldb.slots.acquire()
+            try:
+                conn = ldb.pool.getconn()
+            except Exception:
+                ldb.slots.release()
+                raise
+            g.ldb_conn = conn
+            g.ldb_cdb = conn.cursor()
+            return(g.ldb_cdb)
         except Exception as e:
             print("Failed to connect to report database")
             print(e)
@@ -58,16 +83,45 @@ class ldb():                            # License database class
 
     # Commit changes to the report database
     def commit():
-        ldb.conn.commit()
+        g.ldb_conn.commit()
 
     # Rollback any changes to the report database
     def rollback():
-        ldb.conn.rollback()
+        g.ldb_conn.rollback()
 
-    # Close the report database
+    # Close the report database, returning the connection to the pool.  Any
+    # changes not committed are rolled back first, and a connection that
+    # can't be rolled back (the server went away, say) is thrown away.  This
+    # is also done when each request ends (see ldb_teardown()), so closing
+    # more than once is harmless.
     def close():
-        ldb.cdb.close()
-        ldb.conn.close()
+        conn = g.pop("ldb_conn", None)
+        cdb = g.pop("ldb_cdb", None)
+        if conn == None:
+            return
+        broken = False
+        try:
+            cdb.close()
+            conn.rollback()
+        except Exception:
+            broken = True
+        ldb.pool.putconn(conn, close=broken or conn.closed != 0)
+        ldb.slots.release()
+
+    # Close all the pooled connections; the next open() makes a new pool
+    def discard():
+        with ldb.pool_lock:
+            if ldb.pool != None:
+                ldb.pool.closeall()
+                ldb.pool = None
+
+
+# Return the database connection of each request to the pool when it's done,
+# including the requests that returned early, on an error, without calling
+# ldb.close()
+@app.teardown_appcontext
+def ldb_teardown(exception):
+    ldb.close()
 
 
 # This function returns a list of licenses detected in a package, considering
@@ -107,11 +161,47 @@ def summary_licenses(pkg_id, cdb):
     return expression
 
 
+# Rebuild the packages_per_release rows of the releases matching "where" (a
+# condition on the releases table), from their release_packages and the
+# container_packages of their release_containers.  The release pages look
+# the packages of a release up there, rather than working them out each
+# time.  parse_json() calls this whenever it changes what's in a release or
+# a container.  As for parse_json(), True is returned on error.
+def update_packages_per_release(cdb, s, where):
+    ids = f"SELECT id FROM releases WHERE {where}"
+    sql = f"DELETE FROM packages_per_release WHERE release_id IN ({ids}); \
+            INSERT INTO packages_per_release \
+                   (release_id, package_nvr, source) \
+            SELECT release_id, package_nvr, source \
+            FROM release_packages \
+            WHERE release_id IN ({ids}) \
+            UNION \
+            SELECT release_containers.release_id, \
+                   container_packages.package_nvr, container_packages.source \
+            FROM release_containers \
+            JOIN container_packages ON container_packages.container_id = \
+                                       release_containers.container_id \
+            WHERE release_containers.release_id IN ({ids}) \
+            ON CONFLICT DO NOTHING;"
+    try:
+        cdb.execute(sql)
+        ldb.commit()
+    except Exception as e:
+        ldb.rollback()
+        s.append("error: failed to update the packages of releases<br>")
+        s.append(f"DB error: {e}<br>")
+        return True
+    return False
+
+
 
 # This function examines an uploaded json structure for errors.  If no errors
 # are found, False is returned.  True otherwise.  If the passed "cdb" is
 # is non-None, then perform database updates based on the passed json.
-def parse_json(js, cdb, s):
+# Sources are queued for analysis with the passed "priority".  Sources from a
+# list of several json structures are part of a bulk import, and are given
+# a lower priority.
+def parse_json(js, cdb, s, priority=PRIORITY_INTERACTIVE):
     # We allow four types of json input structures, which are:
     # - Manifest: product, container, release
     # - Source Code: source
@@ -129,8 +219,10 @@ def parse_json(js, cdb, s):
     # on each element of the array.
     if isinstance(js, list):
         s.append(f"Received a list of {len(js)} json import structures<br>")
+        if len(js) > 1:
+            priority = PRIORITY_BULK
         for json_item in js:
-            if parse_json(json_item, cdb, s):
+            if parse_json(json_item, cdb, s, priority):
                 s.append(f"error: failed json import on {json_item}<br>")
                 return True             # Early exit on error
         return False                    # All json structures must have worked
@@ -287,6 +379,11 @@ def parse_json(js, cdb, s):
                              f"{sp['reference']} src_package NVR {nvr}<br>")
                     s.append(f"DB error: {e}<br>")
                     return True
+            # The releases holding this container now have new packages
+            if update_packages_per_release(cdb, s,
+                   f"id IN (SELECT release_id FROM release_containers \
+                            WHERE container_id = {container_id})"):
+                return True
             return False                # Successful container import
         else:
             return False                # Successful container import check
@@ -486,6 +583,8 @@ def parse_json(js, cdb, s):
                              f"{sp['version']} src_package NVR {nvr}<br>")
                     s.append(f"DB error: {e}<br>")
                     return True
+            if update_packages_per_release(cdb, s, f"id = {release_id}"):
+                return True
             return False                # Successful release import
         else:
             return False                # Successful release import check
@@ -512,13 +611,14 @@ def parse_json(js, cdb, s):
         dsp["name"] = sp["name"]
         dsp["type"] = "scnt"
         dsp["fetch"] = sp["fetch_url"]
+        dsp["priority"] = priority
         # print(f"Source container import")
         # print(f"Fetch: {dsp['fetch_url']}")
         # We have done the basic data checks.  As analysis proceeds, other
         # errors might be caught.
         if cdb != None:                 # This block can get skipped
-            sql = "INSERT INTO sources (name, fetch_info, type) \
-                   VALUES (%(name)s, %(fetch)s, %(type)s)"
+            sql = "INSERT INTO sources (name, fetch_info, type, priority) \
+                   VALUES (%(name)s, %(fetch)s, %(type)s, %(priority)s)"
             try:
                 cdb.execute(sql, dsp)
                 ldb.commit()
@@ -528,10 +628,7 @@ def parse_json(js, cdb, s):
                 s.append(f"error: failed to add src_cont {sp['name']}<br>")
                 s.append(f"DB error: {e}<br>")
                 return True
-
-            # Try to kick off the analyze subprocess
-            temp = subprocess.Popen(["python3", analysis_program])
-            s.append("Kicked off the package analysis program<br>")
+            # The analysis daemons are notified of the new source by the DB
             return False                # Successful source import
         else:
             return False                # Successful source import check
@@ -568,13 +665,25 @@ def parse_json(js, cdb, s):
         dsp["name"] = sp["name"]
         dsp["type"] = type
         dsp["fetch"] = json.dumps(sp[type])
+        dsp["priority"] = priority
+        # The size of an uploaded file is known now, which helps analysis to
+        # schedule shorter jobs first.  Other sizes are found out later.
+        dsp["est_size"] = None
+        fetch_url = sp[type].get("fetch_url", "")
+        if isinstance(fetch_url, str) and fetch_url.startswith("file://"):
+            try:
+                dsp["est_size"] = os.path.getsize(fetch_url[7:])
+            except OSError:
+                pass                    # Analysis will report the problem
         # print(f"Source import type {type}")
         # print(f"Fetch: {dsp['fetch']}")
         # We have done the basic data checks.  As analysis proceeds, other
         # errors might be caught.
         if cdb != None:                 # This block can get skipped
-            sql = "INSERT INTO sources (name, fetch_info, type) \
-                   VALUES (%(name)s, %(fetch)s, %(type)s)"
+            sql = "INSERT INTO sources \
+                          (name, fetch_info, type, priority, est_size) \
+                   VALUES (%(name)s, %(fetch)s, %(type)s, %(priority)s, \
+                           %(est_size)s)"
             try:
                 cdb.execute(sql, dsp)
                 ldb.commit()
@@ -584,10 +693,7 @@ def parse_json(js, cdb, s):
                 s.append(f"error: failed to add source {sp['name']}<br>")
                 s.append(f"DB error: {e}<br>")
                 return True
-
-            # Try to kick off the analyze subprocess
-            temp = subprocess.Popen(["python3", analysis_program])
-            s.append("Kicked off the package analysis program<br>")
+            # The analysis daemons are notified of the new source by the DB
             return False                # Successful source import
         else:
             return False                # Successful source import check
@@ -1012,7 +1118,7 @@ def report():
 
         # Grab the summary license information for the packages in this release
         if cont_id == None:
-            if copyrights == 0:         # Skip copyrights (expensive)
+            if copyrights == 0:         # Skip copyrights (not wanted)
                 sql = f"SELECT DISTINCT packages.id, packages.nvr, \
                                         sources.url, \
                                         packages.sum_license, \
@@ -1049,7 +1155,7 @@ def report():
                               packages.source = packages_per_release.source \
                         ORDER BY packages.nvr;"
         else:
-            if copyrights == 0:         # Skip copyrights (expensive)
+            if copyrights == 0:         # Skip copyrights (not wanted)
                 sql = f"SELECT DISTINCT packages.id, packages.nvr, \
                                         sources.url, \
                                         packages.sum_license, \
@@ -1143,8 +1249,6 @@ def report():
                        value={columns[i-1]}>')
         s.append('&nbsp;&nbsp;&nbsp;')
         s.append('<input type=submit value=Update>')
-        s.append('&nbsp;&nbsp;&nbsp;')
-        s.append('(warning: copyrights are slow)')
         s.append('</form></p>')
 
         # Report column headings
@@ -2019,27 +2123,26 @@ def licenses():
                 s.append("<br>Failed to execute container info query")
                 s.append("<br>Error: " + e.args[0])
                 return render_template("base.html", content=s, em=EM)
-            # Collect licenses found in this container
-            sql = f"SELECT DISTINCT COUNT(license_detects.file_id), \
-                                    license_detects.lic_name, \
-                                    MAX(license_detects.score), \
+            # Collect licenses found in this container, from the license
+            # counts of each of its sources (see source_licenses)
+            sql = f"SELECT DISTINCT SUM(source_licenses.detections), \
+                                    source_licenses.lic_name, \
+                                    MAX(source_licenses.max_score), \
                                     COALESCE(licenses.approved, 3) \
                     FROM container_packages \
                     JOIN packages on container_packages.package_nvr = \
                          packages.nvr \
-                    JOIN sources on packages.source_id = sources.id \
-                    JOIN paths on paths.source_id = sources.id \
-                    JOIN license_detects ON license_detects.file_id = \
-                         paths.file_id \
-                    LEFT JOIN licenses ON license_detects.lic_name = \
+                    JOIN source_licenses ON source_licenses.source_id = \
+                         packages.source_id \
+                    LEFT JOIN licenses ON source_licenses.lic_name = \
                                           licenses.key \
                     WHERE container_packages.container_id = {cont_id} AND \
                           packages.source = container_packages.source"
             if unapproved == "1":
                 sql += " AND COALESCE(licenses.approved, 3) != 1"
-            sql += " GROUP BY license_detects.lic_name, \
+            sql += " GROUP BY source_licenses.lic_name, \
                               COALESCE(licenses.approved, 3) \
-                     ORDER BY license_detects.lic_name;"
+                     ORDER BY source_licenses.lic_name;"
             # s.append(f"<br>SQL: {sql}")
 
         elif release_id != None:
@@ -2057,27 +2160,25 @@ def licenses():
                 s.append("<br>Failed to execute release info query")
                 s.append("<br>Error: " + e.args[0])
                 return render_template("base.html", content=s, em=EM)
-            # Collect licenses found in this release
-            sql = f"SELECT DISTINCT COUNT(license_detects.file_id), \
-                                    license_detects.lic_name, \
-                                    MAX(license_detects.score), \
+            # Collect licenses found in this release, as for a container
+            sql = f"SELECT DISTINCT SUM(source_licenses.detections), \
+                                    source_licenses.lic_name, \
+                                    MAX(source_licenses.max_score), \
                                     COALESCE(licenses.approved, 3) \
                     FROM packages_per_release \
                     JOIN packages on packages_per_release.package_nvr = \
                                      packages.nvr \
-                    JOIN sources on packages.source_id = sources.id \
-                    JOIN paths on paths.source_id = sources.id \
-                    JOIN license_detects ON license_detects.file_id = \
-                         paths.file_id \
-                    LEFT JOIN licenses ON license_detects.lic_name = \
+                    JOIN source_licenses ON source_licenses.source_id = \
+                         packages.source_id \
+                    LEFT JOIN licenses ON source_licenses.lic_name = \
                                           licenses.key \
                     WHERE packages_per_release.release_id = {release_id} AND \
                           packages.source = packages_per_release.source"
             if unapproved == "1":
                 sql += " AND COALESCE(licenses.approved, 3) != 1 "
-            sql += " GROUP BY license_detects.lic_name, \
+            sql += " GROUP BY source_licenses.lic_name, \
                               COALESCE(licenses.approved, 3) \
-                     ORDER BY license_detects.lic_name;"
+                     ORDER BY source_licenses.lic_name;"
             # s.append(f"<br>SQL: {sql}")
 
         elif package_id != None:
@@ -2094,23 +2195,22 @@ def licenses():
                 s.append("<br>Failed to execute package query")
                 s.append("<br>Error: " + e.args[0])
                 return render_template("base.html", content=s, em=EM)
-            # Collect licenses found in this package
-            sql = f"SELECT DISTINCT COUNT(license_detects.file_id), \
-                                    license_detects.lic_name, \
-                                    MAX(license_detects.score), \
+            # Collect licenses found in this package, as for a container
+            sql = f"SELECT DISTINCT SUM(source_licenses.detections), \
+                                    source_licenses.lic_name, \
+                                    MAX(source_licenses.max_score), \
                                     COALESCE(licenses.approved, 3) \
-                    FROM license_detects \
-                    JOIN paths ON license_detects.file_id = paths.file_id \
-                    JOIN sources on paths.source_id = sources.id \
-                    JOIN packages on sources.id = packages.source_id \
-                    LEFT JOIN licenses ON license_detects.lic_name = \
+                    FROM source_licenses \
+                    JOIN packages on source_licenses.source_id = \
+                                     packages.source_id \
+                    LEFT JOIN licenses ON source_licenses.lic_name = \
                                           licenses.key \
                     WHERE packages.id = {package_id}"
             if unapproved == "1":
                 sql += " AND COALESCE(licenses.approved, 3) != 1 "
-            sql += " GROUP BY license_detects.lic_name, \
+            sql += " GROUP BY source_licenses.lic_name, \
                               COALESCE(licenses.approved, 3) \
-                     ORDER BY license_detects.lic_name;"
+                     ORDER BY source_licenses.lic_name;"
             # s.append(f"<br>SQL: {sql}")
         else:                           # Query that fails to request anything
             s.append("<br>Unimplemented code (licenses all products)")
@@ -2535,7 +2635,57 @@ def analysis_status():
             s.append("<br>Error: " + e.args[0])
             return render_template("base.html", content=s, em=EM)
 
+        # Sum up the time taken by each analysis stage (see analysis_stages),
+        # to show where the time goes
+        sql = f"SELECT stage, COUNT(*), \
+                       SUM(EXTRACT(EPOCH FROM ended - started)), \
+                       SUM(files), SUM(bytes), SUM(cpu_seconds), \
+                       MAX(max_rss) \
+                FROM analysis_stages \
+                WHERE started > now() - interval '{STAGE_HOURS} hours' \
+                GROUP BY stage \
+                ORDER BY array_position(ARRAY['download', 'swhid', 'unpack', \
+                             'hash', 'prune', 'scan', 'ingest', 'paths']::\
+                             character varying[], stage);"
+        try:
+            cdb.execute(sql)
+            stages = cdb.fetchall()
+        except Exception as e:
+            s.append("<br>Failed to execute analysis stage times query")
+            s.append("<br>Error: " + e.args[0])
+            return render_template("base.html", content=s, em=EM)
+
         # Return the results
+        s.append(f"<p><b>Analysis Stages (last {STAGE_HOURS} hours):</b></p>")
+        s.append('<table class="display">')
+        s.append('<thead><tr>')
+        s.append('<th>Stage</th><th>Runs</th><th>Total Seconds</th>')
+        s.append('<th>Average Seconds</th><th>Files</th><th>MB</th>')
+        s.append('<th>MB/second</th><th>CPU Seconds</th><th>Peak MB</th>')
+        s.append('</tr></thead>')
+        for row in stages:
+            seconds = float(row[2])
+            files = row[3] if row[3] != None else ""
+            mb = rate = ""              # Not all stages count bytes
+            if row[4] != None:
+                mb = f"{row[4] / 1024 ** 2:.1f}"
+                if seconds > 0:
+                    rate = f"{row[4] / 1024 ** 2 / seconds:.1f}"
+            cpu = f"{row[5]:.1f}" if row[5] != None else ""
+            peak = f"{row[6] / 1024 ** 2:.0f}" if row[6] != None else ""
+            s.append(f'<tr>')
+            s.append(f'<td>{row[0]}')
+            s.append(f'<td>{row[1]}')
+            s.append(f'<td>{seconds:.1f}')
+            s.append(f'<td>{seconds / row[1]:.1f}')
+            s.append(f'<td>{files}')
+            s.append(f'<td>{mb}')
+            s.append(f'<td>{rate}')
+            s.append(f'<td>{cpu}')
+            s.append(f'<td>{peak}')
+            s.append(f'</tr>')
+        s.append("</table>")
+
         s.append("<p><b>Package Analysis Queue:</b>")
         s.append(f"Size: {q_size}, Failed: {q_failed},")
         s.append(f"Source Containers: {q_scnt}</p>")
@@ -2566,9 +2716,24 @@ def analysis_status():
 @app.route("/restart_analysis")
 def restart_analysis():
     s = []
+    cdb = ldb.open(DBdatabase, DBhost, DBport, DBuser, DBpassword)
+    if cdb == None:
+        s.append("Bummer...the database isn't connected")
+
+    else:
+        # The analysis daemons LISTEN on this channel, and look for work
+        # whenever it's notified
+        try:
+            cdb.execute("NOTIFY oslcrs_analysis;")
+            ldb.commit()
+            s.append("Notified the package analysis daemons<br>")
+        except Exception as e:
+            ldb.rollback()
+            s.append(f"error: failed to notify the analysis daemons<br>")
+            s.append(f"DB error: {e}<br>")
 
-    temp = subprocess.Popen(["python3", analysis_program])
-    s.append("Kicked off the package analysis program<br>")
+        # Close the DB
+        ldb.close()
 
     return render_template("base.html", content=s, em=EM)
 
@@ -2630,7 +2795,8 @@ def search():
 # by hand.
 #
 
-global corgi_url                        # Where is Corgi? (value set in main())
+global corgi_url                        # Where is Corgi? (value set in
+                                        # create_app())
 
 
 @app.route("/corgi")
@@ -2848,7 +3014,14 @@ def c_manifest():                   # Corgi top-level /report
 #
 
 
-if __name__ == "__main__":
+# Set the application up from the environment, returning it.  This is run
+# when oslcrs.py is run directly (see below), and by a WSGI server, such as
+# gunicorn, importing it as "oslcrs:create_app()".  Everything the pages
+# need is set here as a global.
+def create_app():
+    global db_success, DBhost, DBuser, DBpassword, DBdatabase, DBport, DBpool
+    global EM, TOOLSDIR, FLASKport, corgi_url, tmpinteger, need_row
+
     # Obtain database connection information
     db_success = 0                      # FIXME: Not used
     DBhost = os.environ['DB_HOST']
@@ -2862,6 +3035,13 @@ if __name__ == "__main__":
     print("  DB:  ", DBdatabase)
     print("  User:", DBuser)
 
+    # Requests are served by several threads, sharing up to this many
+    # database connections (see ldb)
+    try:
+        DBpool = int(os.environ['OSLCRS_DB_POOL'])
+    except:
+        DBpool = 10
+
     EM = os.environ['OSLCRS_CONTACT_EMAIL']
 
     # The source container import functionality requires that we have access
@@ -2889,16 +3069,13 @@ if __name__ == "__main__":
 
 
     # Manifest and package uploads require a temporary working directory that
-    # needs to exist.  Ensure we have this subdirectory.
+    # needs to exist.  Ensure we have this subdirectory.  It isn't removed
+    # here, as the analysis daemons started alongside us keep their lock
+    # files and work areas in it; the oslcrs service start clears it instead.
     print("Creating tmp directory for uploads and analysis work...")
-    output = subprocess.run(["/bin/rm", "-rf", "/tmp/oslcrs"],
+    output = subprocess.run(["/bin/mkdir", "-p", "/tmp/oslcrs"],
                             capture_output=True)
     # print(output)
-    if output.returncode != 0:
-        print("  Failed to remove existing tmp directory")
-        exit(1)
-    output = subprocess.run(["/bin/mkdir", "/tmp/oslcrs"], capture_output=True)
-    # print(output)
     if output.returncode != 0:
         print("  Failed to create tmp directory")
         exit(1)
@@ -2909,28 +3086,41 @@ if __name__ == "__main__":
     # Postgres changed sometime between version 9 and 11.  UPDATE SQL requires
     # a ROW() in version 11, where it was illegal in version 9.  This code
     # determines when it's necessary and sets a global variable
-    cdb = ldb.open(DBdatabase, DBhost, DBport, DBuser, DBpassword)
-    if cdb == None:
-        print("Bummer...the database isn't connected")
-        print("Can't run the oslcrs script")
-        exit(1)
-    sql = "SHOW server_version;"
-    try:
-        cdb.execute(sql)
-        row = cdb.fetchone()
-    except Exception as e:
-        print("Failed to query the postgreSQL server version")
-        print("Error: " + e.args[0])
+    # (The connection comes from the pool, which needs an application
+    # context to hold it.)
+    with app.app_context():
+        cdb = ldb.open(DBdatabase, DBhost, DBport, DBuser, DBpassword)
+        if cdb == None:
+            print("Bummer...the database isn't connected")
+            print("Can't run the oslcrs script")
+            exit(1)
+        sql = "SHOW server_version;"
+        try:
+            cdb.execute(sql)
+            row = cdb.fetchone()
+        except Exception as e:
+            print("Failed to query the postgreSQL server version")
+            print("Error: " + e.args[0])
+            ldb.close()
+            exit(1)
+        db_version = row[0].split('.')
         ldb.close()
-        exit(1)
-    db_version = row[0].split('.')
-    ldb.close()
     if int(db_version[0]) > 9:
         need_row = "ROW"
     else:
         need_row = ""
     # print("need_row is", need_row)
 
+    # Drop the connection used above, so that a WSGI server forking its
+    # worker processes after this (gunicorn --preload) doesn't leave them
+    # sharing it; each process makes its own pool when it first needs one
+    ldb.discard()
+    return app
 
-    # Run the Flask application to serve up http pages
-    app.run(host='0.0.0.0', port=FLASKport)
+
+# Run the Flask development server to serve up http pages.  This handles
+# requests in threads of a single process; the oslcrs script runs gunicorn
+# instead, where it's installed.
+if __name__ == "__main__":
+    create_app()
+    app.run(host='0.0.0.0', port=FLASKport, threaded=True)
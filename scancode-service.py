@@ -0,0 +1,93 @@
+# Long-running scancode service, used by analyze.py
+# WARNING...PROTOTYPE CODE
+#
+# Released under GPL version 2
+#
+# Starting scancode for each package means starting Python, discovering all
+# the scancode plugins and loading the license index, every time.  For a
+# small package, that takes longer than the scan.  This service does all that
+# once, then scans directories on request.
+#
+# This script must be run with the Python from the scancode installation,
+# as it imports scancode itself:
+#
+#   ../scancode/bin/python scancode-service.py /tmp/oslcrs-scancode.sock
+#
+# Requests arrive on a Unix socket, one per connection, as a line of JSON:
+#   {"root": "/absolute/path/to/scan", "processes": 8}
+# The reply is the same JSON Lines that "scancode --json-lines" writes,
+# followed by one final line giving the outcome of the scan:
+#   {"scan_status": {"success": true, "errors": "", "cpu": 12.3,
+#                    "rss": 1234567890}}
+# "cpu" is the CPU seconds used by the scan, and "rss" the peak memory (in
+# bytes) of the largest of its processes, for analyze.py to plan by.
+# Each request is handled in a forked child, which shares the already loaded
+# license index with the service.
+
+import json
+import os                               # Environment variable support
+import resource                         # CPU time and peak memory of a scan
+import socketserver                     # Forking Unix socket server
+import sys
+import traceback                        # Error details for the client
+
+from licensedcode.cache import get_index
+from scancode.cli import run_scan
+
+
+# Scan one directory, with the same options analyze.py used to give scancode
+# on the command line ("-plc --only-findings --strip-root --timeout 0
+# --max-depth 0")
+class scan_handler(socketserver.StreamRequestHandler):
+    def handle(self):
+        status = {"success": False, "errors": ""}
+        try:
+            job = json.loads(self.rfile.readline())
+            output = open(self.wfile.fileno(), 'w', closefd=False)
+            success, results = run_scan(job["root"],
+                                        license=True,
+                                        copyright=True,
+                                        package=True,
+                                        only_findings=True,
+                                        strip_root=True,
+                                        processes=job.get("processes", 1),
+                                        timeout=0,
+                                        max_depth=0,
+                                        quiet=True,
+                                        return_results=False,
+                                        output_json_lines=output)
+            output.flush()
+            status["success"] = success
+        except Exception:
+            status["errors"] = traceback.format_exc()
+        own = resource.getrusage(resource.RUSAGE_SELF)
+        children = resource.getrusage(resource.RUSAGE_CHILDREN)
+        status["cpu"] = own.ru_utime + own.ru_stime + \
+                        children.ru_utime + children.ru_stime
+        status["rss"] = max(own.ru_maxrss, children.ru_maxrss) * 1024
+        try:
+            self.wfile.write(bytes(json.dumps({"scan_status": status}) + '\n',
+                                   'UTF-8'))
+        except OSError:
+            pass                        # Client went away
+
+
+class scan_server(socketserver.ForkingMixIn, socketserver.UnixStreamServer):
+    pass
+
+
+#
+# The service starts here
+#
+if len(sys.argv) != 2:
+    print(f"Usage: {sys.argv[0]} socket_path")
+    exit(1)
+sock = sys.argv[1]
+if os.path.exists(sock):
+    os.remove(sock)                     # Left by an earlier run
+
+print("Loading the scancode license index")
+get_index()                             # Load it once, before forking
+with scan_server(sock, scan_handler) as server:
+    print(f"Scancode service listening on {sock}")
+    server.serve_forever()